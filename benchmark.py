@@ -0,0 +1,83 @@
+import os
+os.environ.setdefault('ARCHIVE_HEADLESS', '1')
+import multiprocessing
+import resource
+import sys
+import timeit
+
+'''
+Level generation benchmarks, run without opening a window.
+
+  python benchmark.py          #both benchmarks
+  python benchmark.py sizes    #generation time and memory against map size
+  python benchmark.py levels   #generating LEVEL_COUNT levels in a row
+
+Each map size is generated in a fresh process so that the memory figures do not carry over from one to the
+next. Generation covers everything up to the first frame: make_map, initialise_FOV and a render_all, so the
+chunks a big map generates lazily for the first view are counted too.
+'''
+
+MAP_SIZES = [(80, 50), (250, 250), (500, 500), (1000, 1000), (2000, 2000), (4000, 4000)]
+LEVEL_COUNT = 10000
+
+##########################################################################################
+
+def peak_rss_kb():
+  #the most memory this process has had resident so far (ru_maxrss is in bytes on OS X, KB elsewhere)
+  rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  return rss // 1024 if sys.platform == 'darwin' else rss
+
+def generate(size):
+  #generate and draw the first level at the given map size, returning (ms, peak RSS in KB, chunks generated)
+  import main
+  (main.MAP_WIDTH, main.MAP_HEIGHT) = size
+  main.PREGENERATE_LEVELS = 0  #(the pool's workers cannot start processes of their own)
+  main.initialise_console()
+  #(as play_game sets up for render_all)
+  main.mouse = main.libtcod.Mouse()
+  main.key = main.libtcod.Key()
+  start = timeit.default_timer()
+  main.new_game()
+  (main.camera_x, main.camera_y) = (0, 0)
+  main.render_all()
+  elapsed = (timeit.default_timer() - start) * 1000
+  chunks = len(main.map.chunks) if isinstance(main.map, main.ChunkedTileMap) else 1
+  main.remove_level_files(main.game_seed)  #(a chunked map leaves its store file behind otherwise)
+  return (elapsed, peak_rss_kb(), chunks)
+
+def run_isolated(function, *args):
+  #run function(*args) in a process of its own and return the result
+  pool = multiprocessing.Pool(1, maxtasksperchild=1)
+  try:
+    return pool.apply(function, args)
+  finally:
+    pool.close()
+    pool.join()
+
+##########################################################################################
+
+def bench_map_sizes():
+  print('%-12s %10s %14s %8s' % ('map', 'ms', 'peak RSS (KB)', 'chunks'))
+  for size in MAP_SIZES:
+    (elapsed, rss, chunks) = run_isolated(generate, size)
+    print('%-12s %10.1f %14d %8d' % ('%dx%d' % size, elapsed, rss, chunks))
+
+def bench_levels():
+  #generate LEVEL_COUNT levels back to back at the normal map size, as bulk runs for balancing do
+  import main
+  main.PREGENERATE_LEVELS = 0
+  main.initialise_console()
+  main.new_game()
+  start = timeit.default_timer()
+  for i in range(LEVEL_COUNT):
+    main.make_map()
+  elapsed = timeit.default_timer() - start
+  print('%d levels in %.2fs: %.3f ms per level, %.0f levels/s' %
+        (LEVEL_COUNT, elapsed, elapsed * 1000 / LEVEL_COUNT, LEVEL_COUNT / elapsed))
+
+if __name__ == '__main__':
+  which = sys.argv[1:] or ['sizes', 'levels']
+  if 'sizes' in which:
+    bench_map_sizes()
+  if 'levels' in which:
+    bench_levels()
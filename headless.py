@@ -0,0 +1,569 @@
+from libtcodpy import *
+import heapq
+import random
+import textwrap
+import time
+import numpy as np
+
+'''
+A drop-in replacement for libtcodpy that never opens a window, and never loads the native library either, so
+it runs on machines without SDL (or a display).
+
+Every console is kept in memory as NumPy glyph/foreground/background arrays (indexed [x, y] like the map)
+and input comes from a queue of scripted key presses instead of SDL. The colours, constants and Key/Mouse
+structures are libtcodpy's own (they are plain Python), while random numbers, FOV and A* paths are done here
+in Python. Those work like libtcod's but do not roll or path exactly as it does, so a seed plays out the same
+on every headless run but not the same as it would in a window.
+
+Select it by setting ARCHIVE_HEADLESS before main is imported, then queue up some keys:
+
+  headless.push_key(KEY_CHAR, 'a')  #"Play a new game" in the main menu
+
+Once the queue runs dry the window counts as closed, so play_game() and main_menu() return on their own.
+'''
+
+# Scripted input and the state of the pretend window
+_keys = []
+_closed = False
+_fullscreen = False
+_fps = 0
+_start = time.time()
+
+# The number of times console_flush has been called
+frames = 0
+
+##########################################################################################
+##########################################################################################
+
+
+'''
+#########################
+## <--> Console module ##
+#########################
+'''
+
+
+class _Console:
+  # An offscreen console: a glyph code, foreground and background colour for every cell
+  def __init__(self, w, h):
+    self.width = w
+    self.height = h
+    self.glyph = np.zeros((w, h), dtype=int)
+    self.fg = np.zeros((w, h, 3), dtype=int)
+    self.bg = np.zeros((w, h, 3), dtype=int)
+    self.default_fg = tuple(white)
+    self.default_bg = tuple(black)
+    console_clear(self)
+
+  def clip(self, x, y, w, h):
+    #the part of a rectangle that lies on the console, as a pair of slices (or None if it is all off it)
+    (x0, y0) = (max(x, 0), max(y, 0))
+    (x1, y1) = (min(x + w, self.width), min(y + h, self.height))
+    if x0 >= x1 or y0 >= y1:
+      return None
+    return (slice(x0, x1), slice(y0, y1))
+
+_root = None
+
+def _get(con):
+  #libtcod uses 0 for the root console
+  if con == 0 or con is None:
+    return _root
+  return con
+
+def _blend(dst, col, flag):
+  #apply a background flag to an array of colours, returning the result
+  col = np.array(col, dtype=int)
+  if flag == BKGND_NONE:
+    return dst
+  if flag == BKGND_MULTIPLY:
+    return dst * col // 255
+  if flag == BKGND_LIGHTEN:
+    return np.maximum(dst, col)
+  if flag == BKGND_DARKEN:
+    return np.minimum(dst, col)
+  if flag == BKGND_SCREEN:
+    return 255 - (255 - dst) * (255 - col) // 255
+  if flag == BKGND_ADD:
+    return np.minimum(dst + col, 255)
+  #everything else is treated as a plain set
+  return dst * 0 + col
+
+##########################################################################################
+
+def console_init_root(w, h, title, fullscreen=False, renderer=RENDERER_SDL):
+  global _root, _closed, _fullscreen
+  _root = _Console(w, h)
+  _closed = False
+  _fullscreen = fullscreen
+
+def console_set_custom_font(fontFile, flags=FONT_LAYOUT_ASCII_INCOL, nb_char_horiz=0, nb_char_vertic=0):
+  pass
+
+def console_set_window_title(title):
+  pass
+
+def console_is_fullscreen():
+  return _fullscreen
+
+def console_set_fullscreen(fullscreen):
+  global _fullscreen
+  _fullscreen = fullscreen
+
+def console_is_window_closed():
+  return _closed
+
+def console_flush():
+  global frames
+  frames += 1
+
+def console_new(w, h):
+  return _Console(w, h)
+
+def console_delete(con):
+  pass
+
+def console_get_width(con):
+  return _get(con).width
+
+def console_get_height(con):
+  return _get(con).height
+
+def console_set_default_background(con, col):
+  _get(con).default_bg = tuple(col)
+
+def console_set_default_foreground(con, col):
+  _get(con).default_fg = tuple(col)
+
+def console_get_default_background(con):
+  return Color(*_get(con).default_bg)
+
+def console_get_default_foreground(con):
+  return Color(*_get(con).default_fg)
+
+def console_clear(con):
+  con = _get(con)
+  con.glyph[:] = ord(' ')
+  con.fg[:] = con.default_fg
+  con.bg[:] = con.default_bg
+
+##########################################################################################
+
+def console_put_char(con, x, y, c, flag=BKGND_DEFAULT):
+  con = _get(con)
+  if 0 <= x < con.width and 0 <= y < con.height:
+    con.glyph[x, y] = ord(c) if isinstance(c, (str, bytes)) else c
+    con.fg[x, y] = con.default_fg
+    con.bg[x, y] = _blend(con.bg[x, y], con.default_bg, flag)
+
+def console_put_char_ex(con, x, y, c, fore, back):
+  con = _get(con)
+  if 0 <= x < con.width and 0 <= y < con.height:
+    con.glyph[x, y] = ord(c) if isinstance(c, (str, bytes)) else c
+    con.fg[x, y] = tuple(fore)
+    con.bg[x, y] = tuple(back)
+
+def console_set_char(con, x, y, c):
+  con = _get(con)
+  if 0 <= x < con.width and 0 <= y < con.height:
+    con.glyph[x, y] = ord(c) if isinstance(c, (str, bytes)) else c
+
+def console_set_char_background(con, x, y, col, flag=BKGND_SET):
+  con = _get(con)
+  if 0 <= x < con.width and 0 <= y < con.height:
+    con.bg[x, y] = _blend(con.bg[x, y], col, flag)
+
+def console_set_char_foreground(con, x, y, col):
+  con = _get(con)
+  if 0 <= x < con.width and 0 <= y < con.height:
+    con.fg[x, y] = tuple(col)
+
+def console_get_char(con, x, y):
+  return int(_get(con).glyph[x, y])
+
+def console_get_char_background(con, x, y):
+  return Color(*_get(con).bg[x, y])
+
+def console_get_char_foreground(con, x, y):
+  return Color(*_get(con).fg[x, y])
+
+def console_rect(con, x, y, w, h, clr, flag=BKGND_DEFAULT):
+  con = _get(con)
+  area = con.clip(x, y, w, h)
+  if area is None:
+    return
+  if clr:
+    con.glyph[area] = ord(' ')
+  con.bg[area] = _blend(con.bg[area], con.default_bg, flag)
+
+##########################################################################################
+
+def _wrap(text, w):
+  #split text into the lines libtcod would print it as, wrapping at w columns if w is given
+  lines = []
+  for paragraph in text.split('\n'):
+    if w is None or len(paragraph) <= w:
+      lines.append(paragraph)
+    else:
+      lines.extend(textwrap.wrap(paragraph, w) or [''])
+  return lines
+
+def _print(con, x, y, w, h, flag, alignment, text):
+  #print text line by line, returning the number of lines it took
+  con = _get(con)
+  lines = _wrap(text, w)
+  if h is not None:
+    lines = lines[:h]
+  for (i, line) in enumerate(lines):
+    if alignment == CENTER:
+      start = x - len(line) // 2
+    elif alignment == RIGHT:
+      start = x - len(line) + 1
+    else:
+      start = x
+    for (j, char) in enumerate(line):
+      console_put_char(con, start + j, y + i, char, flag)
+  return len(lines)
+
+def console_print(con, x, y, fmt):
+  _print(con, x, y, None, None, BKGND_NONE, LEFT, fmt)
+
+def console_print_ex(con, x, y, flag, alignment, fmt):
+  _print(con, x, y, None, None, flag, alignment, fmt)
+
+def console_print_rect(con, x, y, w, h, fmt):
+  return _print(con, x, y, w, h or None, BKGND_NONE, LEFT, fmt)
+
+def console_print_rect_ex(con, x, y, w, h, flag, alignment, fmt):
+  return _print(con, x, y, w, h or None, flag, alignment, fmt)
+
+def console_get_height_rect(con, x, y, w, h, fmt):
+  return min(len(_wrap(fmt, w)), h) if h else len(_wrap(fmt, w))
+
+##########################################################################################
+
+def console_blit(src, x, y, w, h, dst, xdst, ydst, ffade=1.0, bfade=1.0):
+  (src, dst) = (_get(src), _get(dst))
+  #a width or height of 0 means the whole source console
+  w = w or src.width
+  h = h or src.height
+  #clip the source rectangle against both consoles
+  (ox, oy) = (xdst - x, ydst - y)
+  (x0, y0) = (max(x, 0, -ox), max(y, 0, -oy))
+  (x1, y1) = (min(x + w, src.width, dst.width - ox), min(y + h, src.height, dst.height - oy))
+  if x0 >= x1 or y0 >= y1:
+    return
+  (sx, sy) = (slice(x0, x1), slice(y0, y1))
+  (dx, dy) = (slice(x0 + ox, x1 + ox), slice(y0 + oy, y1 + oy))
+  dst.glyph[dx, dy] = src.glyph[sx, sy]
+  dst.fg[dx, dy] = (dst.fg[dx, dy] * (1.0 - ffade) + src.fg[sx, sy] * ffade).astype(int)
+  dst.bg[dx, dy] = (dst.bg[dx, dy] * (1.0 - bfade) + src.bg[sx, sy] * bfade).astype(int)
+
+def _fill(target, values, width, height):
+  #the fill functions take their cells row by row
+  target[:] = np.asarray(values, dtype=int).reshape(height, width).T
+
+def console_fill_char(con, arr):
+  con = _get(con)
+  _fill(con.glyph, arr, con.width, con.height)
+
+def console_fill_foreground(con, r, g, b):
+  con = _get(con)
+  if len(r) != len(g) or len(r) != len(b):
+    raise TypeError('R, G and B must all have the same size.')
+  for (i, channel) in enumerate((r, g, b)):
+    _fill(con.fg[:, :, i], channel, con.width, con.height)
+
+def console_fill_background(con, r, g, b):
+  con = _get(con)
+  if len(r) != len(g) or len(r) != len(b):
+    raise TypeError('R, G and B must all have the same size.')
+  for (i, channel) in enumerate((r, g, b)):
+    _fill(con.bg[:, :, i], channel, con.width, con.height)
+
+def console_text(con):
+  #the glyphs on a console as a list of strings, one per row (handy for checking what was drawn)
+  con = _get(con)
+  return [''.join(chr(c) for c in con.glyph[:, y]) for y in range(con.height)]
+
+##########################################################################################
+##########################################################################################
+
+
+'''
+################
+## <--> Input ##
+################
+'''
+
+
+def push_key(vk, c=0, lalt=False):
+  #queue a key press; c may be given as a character
+  _keys.append((vk, ord(c) if isinstance(c, (str, bytes)) else c, lalt))
+
+def _next_key(k):
+  #fill k with the next scripted key press, returning False (and closing the window) if there are none left
+  global _closed
+  if not _keys:
+    _closed = True
+    (k.vk, k.c, k.pressed, k.lalt) = (KEY_NONE, 0, False, False)
+    return False
+  (k.vk, k.c, k.lalt) = _keys.pop(0)
+  k.pressed = True
+  return True
+
+def sys_check_for_event(mask, k, m):
+  if mask & EVENT_KEY_PRESS and _next_key(k):
+    return EVENT_KEY_PRESS
+  return 0
+
+def sys_wait_for_event(mask, k, m, flush):
+  return sys_check_for_event(mask, k, m)
+
+def console_wait_for_keypress(flush):
+  #with nothing left to read, behave as if escape was pressed so that menus do not wait forever
+  k = Key()
+  if not _next_key(k):
+    (k.vk, k.pressed) = (KEY_ESCAPE, True)
+  return k
+
+def console_check_for_keypress(flags=KEY_RELEASED):
+  k = Key()
+  _next_key(k)
+  return k
+
+##########################################################################################
+##########################################################################################
+
+
+'''
+#################
+## <--> System ##
+#################
+'''
+
+
+def sys_set_fps(fps):
+  global _fps
+  _fps = fps
+
+def sys_get_fps():
+  return _fps
+
+def sys_elapsed_milli():
+  return int((time.time() - _start) * 1000)
+
+def sys_elapsed_seconds():
+  return time.time() - _start
+
+def sys_sleep_milli(val):
+  pass
+
+def image_load(filename):
+  return None
+
+def image_blit_2x(image, console, dx, dy, sx=0, sy=0, w=-1, h=-1):
+  pass
+
+##########################################################################################
+##########################################################################################
+
+
+'''
+#################
+## <--> Random ##
+#################
+'''
+
+
+_default_random = random.Random()
+
+def random_get_instance():
+  return _default_random
+
+def random_new(algo=RNG_CMWC):
+  return random.Random()
+
+def random_new_from_seed(seed, algo=RNG_CMWC):
+  return random.Random(seed)
+
+def random_get_int(rnd, mi, ma):
+  #(0 is the default generator, as in libtcod, and the bounds can come either way round)
+  return (rnd or _default_random).randint(min(mi, ma), max(mi, ma))
+
+def random_get_float(rnd, mi, ma):
+  return (rnd or _default_random).uniform(mi, ma)
+
+def random_delete(rnd):
+  pass
+
+##########################################################################################
+##########################################################################################
+
+
+'''
+##############
+## <--> FOV ##
+##############
+'''
+
+
+class _Map:
+  # The cells of a FOV map as a (height, width) array of MAP_CELL_* flags, laid out like libtcod's own so
+  # that map_get_cells/map_set_cells work the same on both
+  def __init__(self, w, h):
+    self.width = w
+    self.height = h
+    self.cells = np.zeros((h, w), dtype=np.uint8)
+
+#the (xx, xy, yx, yy) transforms taking the first octant onto each of the eight
+_OCTANTS = [(1, 0, 0, 1), (0, 1, 1, 0), (0, -1, 1, 0), (-1, 0, 0, 1),
+            (-1, 0, 0, -1), (0, -1, -1, 0), (0, 1, -1, 0), (1, 0, 0, -1)]
+
+def map_new(w, h):
+  return _Map(w, h)
+
+def map_delete(m):
+  pass
+
+def map_get_width(m):
+  return m.width
+
+def map_get_height(m):
+  return m.height
+
+def map_set_properties(m, x, y, isTrans, isWalk):
+  m.cells[y, x] = (MAP_CELL_TRANSPARENT if isTrans else 0) | (MAP_CELL_WALKABLE if isWalk else 0)
+
+def map_clear(m, walkable=False, transparent=False):
+  m.cells[:] = (MAP_CELL_TRANSPARENT if transparent else 0) | (MAP_CELL_WALKABLE if walkable else 0)
+
+def map_is_transparent(m, x, y):
+  return bool(m.cells[y, x] & MAP_CELL_TRANSPARENT)
+
+def map_is_walkable(m, x, y):
+  return bool(m.cells[y, x] & MAP_CELL_WALKABLE)
+
+def map_is_in_fov(m, x, y):
+  return bool(m.cells[y, x] & MAP_CELL_FOV)
+
+def map_get_cells(m):
+  return m.cells
+
+def map_set_cells(m, transparent, walkable):
+  m.cells[:] = np.where(transparent, MAP_CELL_TRANSPARENT, 0) | np.where(walkable, MAP_CELL_WALKABLE, 0)
+
+def map_compute_fov(m, x, y, radius=0, light_walls=True, algo=FOV_RESTRICTIVE):
+  #recursive shadowcasting (whatever algo is asked for), out to radius (0 for no limit)
+  m.cells &= np.uint8(~MAP_CELL_FOV & 0xff)
+  transparent = (m.cells & MAP_CELL_TRANSPARENT) != 0
+  visible = np.zeros((m.height, m.width), dtype=bool)
+  visible[y, x] = True
+  radius = radius if radius > 0 else max(m.width, m.height)
+  for octant in _OCTANTS:
+    _cast_light(transparent, visible, x, y, radius, light_walls, 1, 1.0, 0.0, octant)
+  m.cells[visible] |= MAP_CELL_FOV
+
+def _cast_light(transparent, visible, cx, cy, radius, light_walls, row, start, end, octant):
+  #light one octant from row onwards, between the slopes start and end
+  (xx, xy, yx, yy) = octant
+  (height, width) = transparent.shape
+  if start < end:
+    return
+  for distance in range(row, radius + 1):
+    blocked = False
+    new_start = start
+    for dx in range(-distance, 1):
+      dy = -distance
+      (left, right) = ((dx - 0.5) / (dy + 0.5), (dx + 0.5) / (dy - 0.5))
+      if start < right:
+        continue
+      if end > left:
+        break
+      (x, y) = (cx + dx * xx + dy * xy, cy + dx * yx + dy * yy)
+      inside = 0 <= x < width and 0 <= y < height
+      opaque = not inside or not transparent[y, x]
+      if inside and dx * dx + dy * dy <= radius * radius and (light_walls or not opaque):
+        visible[y, x] = True
+      if blocked:
+        if opaque:
+          new_start = right
+        else:
+          blocked = False
+          start = new_start
+      elif opaque and distance < radius:
+        blocked = True
+        _cast_light(transparent, visible, cx, cy, radius, light_walls, distance + 1, start, left, octant)
+        new_start = right
+    if blocked:
+      break
+
+##########################################################################################
+##########################################################################################
+
+
+'''
+###############
+## <--> Path ##
+###############
+'''
+
+
+class _Path:
+  # An A* path over the walkable cells of a FOV map, moving in any of the 8 directions (diagonals cost dcost)
+  def __init__(self, m, dcost):
+    self.map = m
+    self.dcost = dcost
+    self.steps = []
+
+def path_new_using_map(m, dcost=1.41):
+  return _Path(m, dcost)
+
+def path_delete(p):
+  pass
+
+def path_compute(p, ox, oy, dx, dy):
+  #find the cheapest way from (ox, oy) to (dx, dy), which has to be walkable (the origin does not)
+  p.steps = []
+  (width, height) = (p.map.width, p.map.height)
+  if not (0 <= dx < width and 0 <= dy < height) or not map_is_walkable(p.map, dx, dy):
+    return False
+  if (ox, oy) == (dx, dy):
+    return True
+  walkable = (p.map.cells & MAP_CELL_WALKABLE) != 0
+  def estimate(x, y):
+    (ax, ay) = (abs(dx - x), abs(dy - y))
+    return max(ax, ay) + (p.dcost - 1) * min(ax, ay)
+  came_from = {(ox, oy): None}
+  cost = {(ox, oy): 0.0}
+  queue = [(estimate(ox, oy), 0, (ox, oy))]
+  order = 0  #(so that ties come out in the order they went in)
+  while queue:
+    (_, _, cell) = heapq.heappop(queue)
+    if cell == (dx, dy):
+      while cell != (ox, oy):
+        p.steps.append(cell)
+        cell = came_from[cell]
+      p.steps.reverse()
+      return True
+    (x, y) = cell
+    for (sx, sy) in ((-1, -1), (0, -1), (1, -1), (-1, 0), (1, 0), (-1, 1), (0, 1), (1, 1)):
+      (nx, ny) = (x + sx, y + sy)
+      if not (0 <= nx < width and 0 <= ny < height) or not walkable[ny, nx]:
+        continue
+      new_cost = cost[cell] + (p.dcost if sx and sy else 1.0)
+      if new_cost < cost.get((nx, ny), float('inf')):
+        cost[(nx, ny)] = new_cost
+        came_from[(nx, ny)] = cell
+        order += 1
+        heapq.heappush(queue, (new_cost + estimate(nx, ny), order, (nx, ny)))
+  return False
+
+def path_size(p):
+  return len(p.steps)
+
+def path_get(p, idx):
+  return p.steps[idx]
+
+def path_is_empty(p):
+  return not p.steps
@@ -43,37 +43,60 @@ LINUX=False
 MAC=False
 MINGW=False
 MSVC=False
-if sys.platform.find('linux') != -1:
-    _lib = ctypes.cdll['./libtcod.so']
-    LINUX=True
-elif sys.platform.find('darwin') != -1:
-    _lib = ctypes.cdll['./libtcod.dylib']
-    MAC = True
-elif sys.platform.find('haiku') != -1:
-    _lib = ctypes.cdll['./libtcod.so']
-    HAIKU = True
-else:
-    try:
-        _lib = ctypes.cdll['./libtcod-mingw.dll']
-        MINGW=True
-    except WindowsError:
-        _lib = ctypes.cdll['./libtcod-VS.dll']
-        MSVC=True
-    # On Windows, ctypes doesn't work well with function returning structs,
-    # so we have to user the _wrapper functions instead
-    _lib.TCOD_color_multiply = _lib.TCOD_color_multiply_wrapper
-    _lib.TCOD_color_add = _lib.TCOD_color_add_wrapper
-    _lib.TCOD_color_multiply_scalar = _lib.TCOD_color_multiply_scalar_wrapper
-    _lib.TCOD_color_subtract = _lib.TCOD_color_subtract_wrapper
-    _lib.TCOD_color_lerp = _lib.TCOD_color_lerp_wrapper
-    _lib.TCOD_console_get_default_background = _lib.TCOD_console_get_default_background_wrapper
-    _lib.TCOD_console_get_default_foreground = _lib.TCOD_console_get_default_foreground_wrapper
-    _lib.TCOD_console_get_char_background = _lib.TCOD_console_get_char_background_wrapper
-    _lib.TCOD_console_get_char_foreground = _lib.TCOD_console_get_char_foreground_wrapper
-    _lib.TCOD_console_get_fading_color = _lib.TCOD_console_get_fading_color_wrapper
-    _lib.TCOD_image_get_pixel = _lib.TCOD_image_get_pixel_wrapper
-    _lib.TCOD_image_get_mipmap_pixel = _lib.TCOD_image_get_mipmap_pixel_wrapper
-    _lib.TCOD_parser_get_color_property = _lib.TCOD_parser_get_color_property_wrapper
+
+class _MissingFunction(object):
+    def __init__(self, error):
+        self.error = error
+
+    def __call__(self, *args):
+        raise self.error
+
+class _MissingLibrary(object):
+    # Stands in for the native library when it cannot be loaded (e.g. on a server without SDL), so that the
+    # pure Python parts of this module (colours, constants, Key and Mouse) can still be imported by a backend
+    # that does not need the library, such as headless.py. Calling into it raises the error from loading it.
+    def __init__(self, error):
+        self.error = error
+
+    def __getattr__(self, name):
+        function = _MissingFunction(self.error)
+        setattr(self, name, function)
+        return function
+
+try:
+    if sys.platform.find('linux') != -1:
+        _lib = ctypes.cdll['./libtcod.so']
+        LINUX=True
+    elif sys.platform.find('darwin') != -1:
+        _lib = ctypes.cdll['./libtcod.dylib']
+        MAC = True
+    elif sys.platform.find('haiku') != -1:
+        _lib = ctypes.cdll['./libtcod.so']
+        HAIKU = True
+    else:
+        try:
+            _lib = ctypes.cdll['./libtcod-mingw.dll']
+            MINGW=True
+        except WindowsError:
+            _lib = ctypes.cdll['./libtcod-VS.dll']
+            MSVC=True
+        # On Windows, ctypes doesn't work well with function returning structs,
+        # so we have to user the _wrapper functions instead
+        _lib.TCOD_color_multiply = _lib.TCOD_color_multiply_wrapper
+        _lib.TCOD_color_add = _lib.TCOD_color_add_wrapper
+        _lib.TCOD_color_multiply_scalar = _lib.TCOD_color_multiply_scalar_wrapper
+        _lib.TCOD_color_subtract = _lib.TCOD_color_subtract_wrapper
+        _lib.TCOD_color_lerp = _lib.TCOD_color_lerp_wrapper
+        _lib.TCOD_console_get_default_background = _lib.TCOD_console_get_default_background_wrapper
+        _lib.TCOD_console_get_default_foreground = _lib.TCOD_console_get_default_foreground_wrapper
+        _lib.TCOD_console_get_char_background = _lib.TCOD_console_get_char_background_wrapper
+        _lib.TCOD_console_get_char_foreground = _lib.TCOD_console_get_char_foreground_wrapper
+        _lib.TCOD_console_get_fading_color = _lib.TCOD_console_get_fading_color_wrapper
+        _lib.TCOD_image_get_pixel = _lib.TCOD_image_get_pixel_wrapper
+        _lib.TCOD_image_get_mipmap_pixel = _lib.TCOD_image_get_mipmap_pixel_wrapper
+        _lib.TCOD_parser_get_color_property = _lib.TCOD_parser_get_color_property_wrapper
+except OSError as e:
+    _lib = _MissingLibrary(e)
 
 HEXVERSION = 0x010501
 STRVERSION = "1.5.1"
@@ -914,9 +937,9 @@ def console_fill_foreground(con,r,g,b) :
     if (numpy_available and isinstance(r, numpy.ndarray) and
         isinstance(g, numpy.ndarray) and isinstance(b, numpy.ndarray)):
         #numpy arrays, use numpy's ctypes functions
-        r = numpy.ascontiguousarray(r, dtype=numpy.int_)
-        g = numpy.ascontiguousarray(g, dtype=numpy.int_)
-        b = numpy.ascontiguousarray(b, dtype=numpy.int_)
+        r = numpy.ascontiguousarray(r, dtype=numpy.intc)
+        g = numpy.ascontiguousarray(g, dtype=numpy.intc)
+        b = numpy.ascontiguousarray(b, dtype=numpy.intc)
         cr = r.ctypes.data_as(POINTER(c_int))
         cg = g.ctypes.data_as(POINTER(c_int))
         cb = b.ctypes.data_as(POINTER(c_int))
@@ -935,9 +958,9 @@ def console_fill_background(con,r,g,b) :
     if (numpy_available and isinstance(r, numpy.ndarray) and
         isinstance(g, numpy.ndarray) and isinstance(b, numpy.ndarray)):
         #numpy arrays, use numpy's ctypes functions
-        r = numpy.ascontiguousarray(r, dtype=numpy.int_)
-        g = numpy.ascontiguousarray(g, dtype=numpy.int_)
-        b = numpy.ascontiguousarray(b, dtype=numpy.int_)
+        r = numpy.ascontiguousarray(r, dtype=numpy.intc)
+        g = numpy.ascontiguousarray(g, dtype=numpy.intc)
+        b = numpy.ascontiguousarray(b, dtype=numpy.intc)
         cr = r.ctypes.data_as(POINTER(c_int))
         cg = g.ctypes.data_as(POINTER(c_int))
         cb = b.ctypes.data_as(POINTER(c_int))
@@ -952,7 +975,7 @@ def console_fill_background(con,r,g,b) :
 def console_fill_char(con,arr) :
     if (numpy_available and isinstance(arr, numpy.ndarray) ):
         #numpy arrays, use numpy's ctypes functions
-        arr = numpy.ascontiguousarray(arr, dtype=numpy.int_)
+        arr = numpy.ascontiguousarray(arr, dtype=numpy.intc)
         carr = arr.ctypes.data_as(POINTER(c_int))
     else:
         #otherwise convert using the struct module
@@ -1543,6 +1566,32 @@ def map_get_width(map):
 def map_get_height(map):
     return _lib.TCOD_map_get_height(map)
 
+# direct access to the map cells (requires NumPy). In libtcod 1.5.1 a map is
+# {int width, height, nbcells; cell_t *cells} and each cell_t packs the
+# transparent, walkable and fov flags into the low bits of one byte.
+class _CMap(Structure):
+    _fields_ = [('width', c_int),
+                ('height', c_int),
+                ('nbcells', c_int),
+                ('cells', POINTER(c_uint8)),
+                ]
+
+MAP_CELL_TRANSPARENT = 1
+MAP_CELL_WALKABLE = 2
+MAP_CELL_FOV = 4
+
+def map_get_cells(m):
+    # returns a (height, width) uint8 array sharing memory with the map's cells
+    cmap = cast(c_void_p(m), POINTER(_CMap)).contents
+    return numpy.ctypeslib.as_array(cmap.cells, shape=(cmap.height, cmap.width))
+
+def map_set_cells(m, transparent, walkable):
+    # sets the properties of every cell at once from two (height, width) boolean arrays
+    # (this also clears the fov flags, so compute the fov again afterwards)
+    cells = map_get_cells(m)
+    cells[:] = (numpy.where(transparent, MAP_CELL_TRANSPARENT, 0) |
+                numpy.where(walkable, MAP_CELL_WALKABLE, 0))
+
 ############################
 # pathfinding module
 ############################
@@ -1,7 +1,23 @@
-import libtcodpy as libtcod
+import os
+if os.environ.get('ARCHIVE_HEADLESS'):
+  import headless as libtcod  #no window: consoles live in memory and input is scripted
+else:
+  import libtcodpy as libtcod
+import numpy as np
 import math
 import textwrap
 import shelve
+import pickle
+import zlib
+import collections
+import heapq
+import contextlib
+import mmap
+import glob
+import multiprocessing
+import timeit
+import csv
+import json
 
 '''
 # <--!> is a TODO comment
@@ -10,7 +26,7 @@ import shelve
 >> libtcod built in colours::    http://doryen.eptalys.net/data/libtcod/doc/1.5.1/html2/color.html
 
 BUGS::
-ai sometimes not chasing player
+ai sometimes not chasing player [fixed?? now follows a flow field]
 level up hp going over max [fixed??]
 elevator not perma-visible after discovery
 
@@ -49,6 +65,20 @@ CAMERA_HEIGHT = 38
 
 LIMIT_FPS = 20
 
+# The main loop sleeps until there is input and only renders after something changed, rather than
+# polling at LIMIT_FPS. While anything is moving on screen (see keep_loop_active) it runs at ACTIVE_FPS,
+# e.g. for HOVER_ACTIVE_MS after the mouse last moved.
+EVENT_DRIVEN_LOOP = True
+ACTIVE_FPS = 60
+HOVER_ACTIVE_MS = 500
+loop_active_until = 0
+
+# How many wrapped menu header heights to remember
+HEADER_CACHE_SIZE = 64
+
+# Where play_game dumps its per-phase frame timings (as .csv and .json) on exit
+FRAME_TIMES_PATH = 'game_data/frame_times'
+
 # Sizes and coordinates relevant for the GUI
 BAR_WIDTH = 20
 PANEL_HEIGHT = 7
@@ -63,6 +93,10 @@ HELP_SCREEN_WIDTH = 50
 
 # The list of game messages and their colours, starts empty
 game_msgs = []
+# Bumped whenever a message is added, so the GUI panel knows when to redraw
+game_msgs_version = 0
+# What the GUI panel was last drawn with (None forces a redraw)
+panel_state = None
 
 # Map generation parameters
 color_dark_wall = libtcod.darkest_azure
@@ -70,10 +104,55 @@ color_light_wall = libtcod.desaturated_orange
 color_dark_ground = libtcod.darker_azure
 color_light_ground = libtcod.desaturated_amber
 
+# Terrain types: every tile carries one of these ids, which decides how it blocks and what colour it is drawn in
+TERRAIN_WALL = 0
+TERRAIN_FLOOR = 1
+TERRAIN_RUINED_FLOOR = 2
+TERRAIN_SECURITY_ZONE = 3
+
+# For each terrain type: (blocked, block_sight, colour once explored, colour while in view)
+TERRAIN_TYPES = [
+  (True, True, color_dark_wall, color_light_wall),  #TERRAIN_WALL
+  (False, False, color_dark_ground, color_light_ground),  #TERRAIN_FLOOR
+  (False, False, libtcod.darkest_sepia, libtcod.dark_sepia),  #TERRAIN_RUINED_FLOOR
+  (False, False, libtcod.darkest_crimson, libtcod.desaturated_crimson),  #TERRAIN_SECURITY_ZONE
+]
+
+# Background colour lookup table, indexed by [terrain, state] where the state is 0 for unexplored
+# (black, like a cleared console), 1 for explored but out of view and 2 for in view
+TERRAIN_BLOCKED = np.array([blocked for (blocked, block_sight, dark, light) in TERRAIN_TYPES])
+TERRAIN_BLOCKS_SIGHT = np.array([block_sight for (blocked, block_sight, dark, light) in TERRAIN_TYPES])
+TERRAIN_PALETTE = np.array([[tuple(libtcod.black), tuple(dark), tuple(light)] for (blocked, block_sight, dark, light) in TERRAIN_TYPES])
+
 ROOM_MAX_SIZE = 12
 ROOM_MIN_SIZE = 7
 MAX_ROOMS = 60
 
+# Maps with more cells than this are split into CHUNK_SIZE x CHUNK_SIZE chunks that are generated as they
+# come into view, rather than all at once
+MAX_DENSE_MAP_CELLS = 256 * 256
+CHUNK_SIZE = 64
+MAX_ROOMS_PER_CHUNK = 60
+# Where each chunked level keeps its tiles (see ChunkStore), by game seed and archive depth, so that a new game
+# never writes over the files of the levels in a save
+LEVEL_STORE_PATH = 'game_data/level_%d_%d.chunks'
+# Levels the player has left are kept (compressed) in memory up to this many bytes; beyond that the least
+# recently visited are written out to LEVEL_SNAPSHOT_PATH (by game seed and depth)
+LEVEL_CACHE_BYTES = 4 * 1024 * 1024
+LEVEL_SNAPSHOT_PATH = 'game_data/level_%d_%d.snapshot'
+# Every level file of the game with a given seed
+LEVEL_FILES = 'game_data/level_%d_*'
+# How many floors below the current one to generate ahead of time in worker processes (0 to build each level
+# only when the player gets there)
+PREGENERATE_LEVELS = 2
+# Every level is generated from a seed worked out from the game's seed and its depth (see level_seed)
+game_seed = 0
+# Named random streams, so that an extra roll in one part of the game does not shift the rolls everywhere else:
+# worldgen lays levels out, spawning fills them with enemies and items, combat and ai are rolled on during play.
+# They are reseeded from the level's seed on entering each level (see seed_streams)
+RNG_STREAMS = ('worldgen', 'spawning', 'combat', 'ai')
+streams = {}  #name -> libtcod random stream
+
 LEVEL_UP_BASE = 100
 LEVEL_UP_FACTOR = 120
 
@@ -83,7 +162,30 @@ NEW_FLOOR_HEAL = 10
 FOV_ALGO = 2
 FOV_LIGHT_WALLS = True
 TORCH_RADIUS = 7
-fov_noise = libtcod.noise_new(1, 1.0, 1.0)
+# How far around the player the flow field enemies chase along reaches
+FLOW_FIELD_RADIUS = 24
+# Hunters keep following the path they worked out while the player stays within this many tiles of where it
+# led; path_map is the FOV window again, but with anything blocking (enemies too) marked as unwalkable
+PATH_TOLERANCE = 2
+# Turn scheduling: a move or attack takes ACTION_COST ticks for something of NORMAL_SPEED (like the player).
+# Enemies only act while awake, which they do on coming within WAKE_RADIUS of the player, and they fall
+# asleep again once they are more than SLEEP_RADIUS away (unless hunting). A hunter gives up, and can fall
+# asleep, after HUNT_TURNS turns of neither seeing nor hearing the player
+ACTION_COST = 100
+NORMAL_SPEED = 100
+WAKE_RADIUS = 2 * TORCH_RADIUS
+SLEEP_RADIUS = 3 * TORCH_RADIUS
+HUNT_TURNS = 20
+# How far (in moves) the sound of a fight carries; anything that hears a noise wakes up and goes to look
+ATTACK_NOISE = 8
+path_map = None
+hunt_path = None
+fov_map = None
+# On big maps libtcod only holds a window of the map around the player for FOV, reloaded as the camera
+# reaches its edge; fov_origin is the map position of its top left corner
+FOV_WINDOW_WIDTH = CAMERA_WIDTH * 2
+FOV_WINDOW_HEIGHT = CAMERA_HEIGHT * 2
+fov_origin = (0, 0)
 
 ##########################################################################################
 ##########################################################################################
@@ -107,6 +209,7 @@ SHOCK_RANGE = 5
 # Grenades
 GRENADO_RADIUS = 2
 GRENADO_DAMAGE = 25
+GRENADO_NOISE = 20
 
 # Buff / Debuff
 CONFUSE_RANGE = 6
@@ -159,6 +262,7 @@ class Object:
     if not is_blocked(self.x + dx, self.y + dy):
       self.x += dx
       self.y += dy
+      object_index.move(self)
 
   def move_towards(self, target_x, target_y):
     #vector from this object to the target, and distance
@@ -187,32 +291,362 @@ class Object:
     objects.remove(self)
     objects.insert(0, self)
 
-  def draw(self):
-    #only show if it's visible to the player
-    if libtcod.map_is_in_fov(fov_map, self.x, self.y):
-      (x, y) = to_camera_coordinates(self.x, self.y)
-      if x is not None:
-        #set the color and then draw the character that represents this object at its position
-        libtcod.console_set_default_foreground(con, self.colour)
-        libtcod.console_put_char(con, x, y, self.char, libtcod.BKGND_NONE)
-
-  def clear(self):
-    #erase the character that represents this object
-    (x, y) = to_camera_coordinates(self.x, self.y)
-    if x is not None:
-      libtcod.console_put_char(con, x, y, ' ', libtcod.BKGND_NONE)
-
 #################################################################################################################################
 
 class Tile:
-  #Define a tile on the map and its properties: can it be traversed, can you see through it
-  def __init__(self, blocked, block_sight = None):
+  #Define a tile on the map and its properties: can it be traversed, can you see through it, what terrain is it
+  #NOTE:: maps are now stored as a TileMap; this is what each tile of a map looked like in older saves
+  def __init__(self, blocked, block_sight = None, terrain = None):
     self.blocked = blocked
     self.explored = False
   #By default, if a tile is blocked, it also blocks sight
     if block_sight is None:
       block_sight = blocked
       self.block_sight = block_sight
+  #and it is a wall, otherwise it is plain floor
+    if terrain is None:
+      terrain = TERRAIN_WALL if blocked else TERRAIN_FLOOR
+    self.terrain = terrain
+
+#################################################################################################################################
+
+class TileMap(object):
+  # The level map, stored as one NumPy array per tile property (each indexed [x, y]) rather than a Tile object per cell.
+  # map[x][y] still gives a TileRef, so map[x][y].blocked style reads and writes keep working for single tiles,
+  # while whole-map passes can work on the arrays directly.
+  # The (terrain, blocked, block_sight, explored) arrays can be passed in as layers (e.g. views of a ChunkStore)
+  # rather than allocated; with terrain=None whatever tiles they already hold are kept.
+  def __init__(self, width, height, terrain=TERRAIN_WALL, layers=None):
+    self.width = width
+    self.height = height
+    if layers is None:
+      layers = (np.zeros((width, height), dtype=np.uint8), np.zeros((width, height), dtype=bool),
+                np.zeros((width, height), dtype=bool), np.zeros((width, height), dtype=bool))
+    (self.terrain, self.blocked, self.block_sight, self.explored) = layers
+    #how many blocking objects stand on each tile, and whether the tile can be entered at all (its terrain
+    #is blocked or something blocking is standing on it); these are kept up to date by a SpatialIndex
+    self.occupied = np.zeros((width, height), dtype=np.int16)
+    self.impassable = np.zeros((width, height), dtype=bool)
+    if terrain is None:
+      self.clear_occupancy()
+    else:
+      self.set_terrain(slice(None), slice(None), terrain)
+
+  @classmethod
+  def from_tiles(cls, tiles):
+    #convert a list of lists of Tiles (as found in older saves)
+    tile_map = cls(len(tiles), len(tiles[0]))
+    for (x, column) in enumerate(tiles):
+      for (y, tile) in enumerate(column):
+        terrain = getattr(tile, 'terrain', TERRAIN_WALL if tile.block_sight else TERRAIN_FLOOR)
+        (tile_map.terrain[x, y], tile_map.explored[x, y]) = (terrain, tile.explored)
+        (tile_map.blocked[x, y], tile_map.block_sight[x, y]) = (tile.blocked, tile.block_sight)
+    tile_map.clear_occupancy()
+    return tile_map
+
+  def set_terrain(self, x, y, terrain):
+    #turn a tile (or, given slices or index arrays, a whole area) into another terrain type, taking on its blocking properties
+    self.terrain[x, y] = terrain
+    self.blocked[x, y] = TERRAIN_BLOCKED[terrain]
+    self.block_sight[x, y] = TERRAIN_BLOCKS_SIGHT[terrain]
+    self.impassable[x, y] = self.blocked[x, y] | (self.occupied[x, y] > 0)
+
+  def set_blocked(self, x, y, blocked):
+    #make a tile (or area) passable or not without changing its terrain
+    self.blocked[x, y] = blocked
+    self.impassable[x, y] = self.blocked[x, y] | (self.occupied[x, y] > 0)
+
+  def occupy(self, x, y, count):
+    #record that count more (or if negative, fewer) blocking objects are standing on a tile
+    self.occupied[x, y] += count
+    self.impassable[x, y] = self.blocked[x, y] | (self.occupied[x, y] > 0)
+
+  def clear_occupancy(self):
+    self.occupied[:] = 0
+    self.impassable[:] = self.blocked
+
+  def __len__(self):
+    return self.width
+
+  def __getitem__(self, x):
+    return _TileColumn(self, x)
+
+  def __iter__(self):
+    for x in range(self.width):
+      yield _TileColumn(self, x)
+
+class _TileColumn(object):
+  # One column of a TileMap, so that map[x][y] works
+  __slots__ = ('map', 'x')
+  def __init__(self, tile_map, x):
+    self.map = tile_map
+    self.x = x
+
+  def __len__(self):
+    return self.map.height
+
+  def __getitem__(self, y):
+    return TileRef(self.map, self.x, y)
+
+  def __iter__(self):
+    for y in range(self.map.height):
+      yield TileRef(self.map, self.x, y)
+
+class TileRef(object):
+  # A single tile of a TileMap, reading and writing straight through to the map's arrays
+  __slots__ = ('map', 'x', 'y')
+  def __init__(self, tile_map, x, y):
+    self.map = tile_map
+    self.x = x
+    self.y = y
+
+  @property
+  def blocked(self):
+    return bool(self.map.blocked[self.x, self.y])
+
+  @blocked.setter
+  def blocked(self, blocked):
+    self.map.set_blocked(self.x, self.y, blocked)  #(which keeps the map's impassable layer in step)
+
+  @property
+  def block_sight(self):
+    return bool(self.map.block_sight[self.x, self.y])
+
+  @block_sight.setter
+  def block_sight(self, block_sight):
+    self.map.block_sight[self.x, self.y] = block_sight
+
+  @property
+  def explored(self):
+    return bool(self.map.explored[self.x, self.y])
+
+  @explored.setter
+  def explored(self, explored):
+    self.map.explored[self.x, self.y] = explored
+
+  @property
+  def terrain(self):
+    return int(self.map.terrain[self.x, self.y])
+
+  @terrain.setter
+  def terrain(self, terrain):
+    self.map.set_terrain(self.x, self.y, terrain)
+
+#################################################################################################################################
+
+class ChunkedTileMap(object):
+  # A level too big to generate or hold in one go. It is split into CHUNK_SIZE x CHUNK_SIZE TileMaps, and each
+  # chunk is only carved and populated (see generate_chunk) the first time anything looks at it, so the cost of
+  # a new level does not grow with its size. It works like a TileMap: map[x][y], set_terrain and the occupancy
+  # methods behave the same, and each layer (map.blocked, map.explored...) can be indexed with [x, y] or read
+  # and written a region at a time with [x0:x1, y0:y1] (reads give a copy rather than a view).
+  # The tiles themselves live in a ChunkStore file rather than in memory, so pickling the map (see save_game)
+  # only writes out its size, seed and where that file is; chunks are mapped back in as they are used.
+  LAYERS = ('terrain', 'blocked', 'block_sight', 'explored', 'occupied', 'impassable')
+
+  def __init__(self, width, height, seed, path):
+    self.width = width
+    self.height = height
+    self.seed = seed
+    self.chunks_wide = (width + CHUNK_SIZE - 1) // CHUNK_SIZE
+    self.chunks_high = (height + CHUNK_SIZE - 1) // CHUNK_SIZE
+    self.store = ChunkStore(path, self.chunks_wide, self.chunks_high, 'w+')
+    self.chunks = {}  #(chunk_x, chunk_y) -> TileMap over the chunk's part of the store
+    self.centres = {}  #(chunk_x, chunk_y) -> centres of the rooms carved into that chunk
+    self.unsaved = set()  #chunks generated since the store was last flushed
+
+  def __getattr__(self, name):
+    if name in ChunkedTileMap.LAYERS:
+      return _ChunkedLayer(self, name)
+    raise AttributeError(name)
+
+  def __getstate__(self):
+    #the chunks are only views of the store (plus occupancy, which the SpatialIndex rebuilds), so leave them out
+    self.flush()
+    state = self.__dict__.copy()
+    state['chunks'] = {}
+    return state
+
+  def __setstate__(self, state):
+    self.__dict__.update(state)
+
+  def flush(self):
+    #write the chunks changed since the last flush back to the store's file
+    for (chunk_x, chunk_y) in self.unsaved:
+      self.store.generated[chunk_x, chunk_y] = True
+    self.unsaved.clear()
+    self.store.flush()
+
+  def close(self, delete=False):
+    #let go of the store (and with delete=True, its file) once the level is done with
+    self.chunks.clear()
+    self.store.close(delete)
+
+  def chunk_bounds(self, chunk_x, chunk_y):
+    #(x, y, width, height) of a chunk; the chunks on the far edges may be cut short
+    (x, y) = (chunk_x * CHUNK_SIZE, chunk_y * CHUNK_SIZE)
+    return (x, y, min(CHUNK_SIZE, self.width - x), min(CHUNK_SIZE, self.height - y))
+
+  def chunk_seed(self, chunk_x, chunk_y):
+    return (self.seed * 73856093 ^ chunk_x * 19349663 ^ chunk_y * 83492791) & 0x7fffffff
+
+  def chunk_exits(self, chunk_x, chunk_y):
+    #a point on each edge this chunk shares with another, placed at a spot derived from the seed and the
+    #edge so that the chunk on the other side of it picks the matching point
+    (x, y, width, height) = self.chunk_bounds(chunk_x, chunk_y)
+    exits = []
+    if chunk_x > 0:  #west
+      exits.append((x, y + _edge_offset(self.chunk_seed(chunk_x, 2 * chunk_y), height)))
+    if chunk_x < self.chunks_wide - 1:  #east
+      exits.append((x + width - 1, y + _edge_offset(self.chunk_seed(chunk_x + 1, 2 * chunk_y), height)))
+    if chunk_y > 0:  #north
+      exits.append((x + _edge_offset(self.chunk_seed(chunk_x, 2 * chunk_y + 1), width), y))
+    if chunk_y < self.chunks_high - 1:  #south
+      exits.append((x + _edge_offset(self.chunk_seed(chunk_x, 2 * chunk_y + 3), width), y + height - 1))
+    return exits
+
+  def chunk(self, chunk_x, chunk_y):
+    #the TileMap for a chunk, mapping it in from the store, or generating it if this is the first time it has
+    #been asked for
+    key = (chunk_x, chunk_y)
+    if key not in self.chunks:
+      (x, y, width, height) = self.chunk_bounds(chunk_x, chunk_y)
+      layers = self.store.layers(chunk_x, chunk_y, width, height)
+      if self.store.generated[chunk_x, chunk_y]:
+        self.chunks[key] = TileMap(width, height, None, layers)
+      else:
+        #register the chunk before generating it, since carving it looks it up
+        self.chunks[key] = TileMap(width, height, TERRAIN_WALL, layers)
+        self.centres[key] = generate_chunk(self, chunk_x, chunk_y)
+        self.unsaved.add(key)
+    return self.chunks[key]
+
+  def room_centres(self, chunk_x, chunk_y):
+    self.chunk(chunk_x, chunk_y)
+    return self.centres[(chunk_x, chunk_y)]
+
+  def blocks(self, x, y):
+    #split an index into the map (ints or slices for x and y) into (chunk, index into the chunk, index into the
+    #result) for each chunk it touches. The index into the result is None when x and y are both ints
+    if isinstance(x, slice) or isinstance(y, slice):
+      (x0, x1) = _slice_bounds(x, self.width)
+      (y0, y1) = _slice_bounds(y, self.height)
+      for chunk_x in range(x0 // CHUNK_SIZE, (x1 - 1) // CHUNK_SIZE + 1):
+        for chunk_y in range(y0 // CHUNK_SIZE, (y1 - 1) // CHUNK_SIZE + 1):
+          (cx, cy, width, height) = self.chunk_bounds(chunk_x, chunk_y)
+          (bx0, bx1) = (max(x0, cx), min(x1, cx + width))
+          (by0, by1) = (max(y0, cy), min(y1, cy + height))
+          yield (self.chunk(chunk_x, chunk_y), (slice(bx0 - cx, bx1 - cx), slice(by0 - cy, by1 - cy)),
+                 (slice(bx0 - x0, bx1 - x0), slice(by0 - y0, by1 - y0)))
+    else:
+      if not (0 <= x < self.width and 0 <= y < self.height):
+        raise IndexError('(%d, %d) is off the map' % (x, y))
+      yield (self.chunk(x // CHUNK_SIZE, y // CHUNK_SIZE), (x % CHUNK_SIZE, y % CHUNK_SIZE), None)
+
+  def set_terrain(self, x, y, terrain):
+    for (chunk, local, part) in self.blocks(x, y):
+      chunk.set_terrain(local[0], local[1], terrain)
+
+  def set_blocked(self, x, y, blocked):
+    for (chunk, local, part) in self.blocks(x, y):
+      chunk.set_blocked(local[0], local[1], blocked)
+
+  def occupy(self, x, y, count):
+    for (chunk, local, part) in self.blocks(x, y):
+      chunk.occupy(local[0], local[1], count)
+
+  def clear_occupancy(self):
+    for chunk in self.chunks.values():
+      chunk.clear_occupancy()
+
+  def __len__(self):
+    return self.width
+
+  def __getitem__(self, x):
+    return _TileColumn(self, x)
+
+  def __iter__(self):
+    for x in range(self.width):
+      yield _TileColumn(self, x)
+
+class ChunkStore(object):
+  # The tiles of a ChunkedTileMap, memory-mapped from a file so that the OS only pages in the chunks that are
+  # actually being looked at. The file starts with a page holding a flag per chunk (set once the chunk has
+  # been generated and saved), followed by each chunk's terrain, blocked, block_sight and explored layers
+  # stored together, one byte per tile.
+  LAYERS = 4
+
+  def __init__(self, path, chunks_wide, chunks_high, mode='r+'):
+    self.path = path
+    self.shape = (chunks_wide, chunks_high)
+    self.open(mode)
+
+  def open(self, mode):
+    (chunks_wide, chunks_high) = self.shape
+    header = -(-chunks_wide * chunks_high // mmap.PAGESIZE) * mmap.PAGESIZE
+    size = header + chunks_wide * chunks_high * ChunkStore.LAYERS * CHUNK_SIZE * CHUNK_SIZE
+    self.data = np.memmap(self.path, dtype=np.uint8, mode=mode, shape=(size,))
+    self.generated = self.data[:chunks_wide * chunks_high].view(bool).reshape(self.shape)
+    self.tiles = self.data[header:].reshape(self.shape + (ChunkStore.LAYERS, CHUNK_SIZE, CHUNK_SIZE))
+
+  def layers(self, chunk_x, chunk_y, width, height):
+    #views of a chunk's (terrain, blocked, block_sight, explored) layers, for a TileMap to work on directly
+    tiles = self.tiles[chunk_x, chunk_y, :, :width, :height]
+    return (tiles[0], tiles[1].view(bool), tiles[2].view(bool), tiles[3].view(bool))
+
+  def flush(self):
+    #the OS only writes back the pages that have changed
+    self.data.flush()
+
+  def close(self, delete=False):
+    del self.data, self.generated, self.tiles
+    if delete and os.path.exists(self.path):
+      os.remove(self.path)
+
+  def __getstate__(self):
+    return {'path': self.path, 'shape': self.shape}
+
+  def __setstate__(self, state):
+    self.__dict__.update(state)
+    self.open('r+')
+
+class _ChunkedLayer(object):
+  # One layer (terrain, blocked...) of a ChunkedTileMap, indexed like the matching TileMap array
+  __slots__ = ('map', 'name')
+  def __init__(self, chunk_map, name):
+    self.map = chunk_map
+    self.name = name
+
+  def __getitem__(self, index):
+    (x, y) = index
+    result = None
+    for (chunk, local, part) in self.map.blocks(x, y):
+      values = getattr(chunk, self.name)
+      if part is None:
+        return values[local]
+      if result is None:
+        (x0, x1) = _slice_bounds(x, self.map.width)
+        (y0, y1) = _slice_bounds(y, self.map.height)
+        result = np.empty((x1 - x0, y1 - y0), dtype=values.dtype)
+      result[part] = values[local]
+    return result
+
+  def __setitem__(self, index, value):
+    (x, y) = index
+    value = np.asarray(value)
+    for (chunk, local, part) in self.map.blocks(x, y):
+      getattr(chunk, self.name)[local] = value[part] if (part is not None and value.ndim) else value
+
+def _edge_offset(seed, length):
+  #a position along a chunk edge of the given length, keeping off the corners where there is room to
+  return 1 + seed % (length - 2) if length > 2 else 0
+
+def _slice_bounds(index, size):
+  #the (start, stop) of a slice (or a single index) into 0..size, without steps
+  if isinstance(index, slice):
+    (start, stop, step) = index.indices(size)
+    return (start, max(start, stop))
+  return (index, index + 1)
 
 #################################################################################################################################
 
@@ -233,6 +667,11 @@ class Rect:
   # Note that (x1,y1) is the top left corner and (x2,y2) is the bottom right
     return (self.x1 <= other.x2 and self.x2 >= other.x1 and self.y1 <= other.y2 and self.y2 >= other.y1)
 
+  def intersect_any(self, bounds):
+  # The same test against many rectangles at once, given as an array with a row of (x1, y1, x2, y2) for each
+    return bool(np.any((self.x1 <= bounds[:, 2]) & (self.x2 >= bounds[:, 0]) &
+                       (self.y1 <= bounds[:, 3]) & (self.y2 >= bounds[:, 1])))
+
 #################################################################################################################################
 
 class Item:
@@ -248,6 +687,7 @@ class Item:
     else:
       inventory.append(self.owner)
       objects.remove(self.owner)
+      object_index.remove(self.owner)
       message('You picked up a ' + self.owner.name + '!', libtcod.green)
       #special case: automatically equip, if the corresponding equipment slot is unused
       equipment = self.owner.equipment
@@ -275,6 +715,7 @@ class Item:
     inventory.remove(self.owner)
     self.owner.x = player.x
     self.owner.y = player.y
+    object_index.add(self.owner)
     message('You dropped a ' + self.owner.name + '.', libtcod.yellow)
 
 #################################################################################################################################
@@ -311,6 +752,588 @@ class Equipment:
     self.is_equipped = False
     message('Dequipped ' + self.owner.name + ' from ' + self.slot + '.', libtcod.light_yellow)
 
+#################################################################################################################################
+
+class SpatialIndex:
+  # Buckets game objects by the map cell they are on, so finding what is at (or near) a position only looks at
+  # the objects there rather than scanning the whole objects list. It also keeps the map's occupancy of
+  # blocking objects current. Anything that moves an object, takes it on or off the map, or changes
+  # whether it blocks has to tell the index.
+  def __init__(self, tile_map, objects=()):
+    self.map = tile_map
+    self.cells = {}  #(x, y) -> objects on that cell
+    self.where = {}  #object -> the cell it is filed under
+    tile_map.clear_occupancy()
+    for obj in objects:
+      self.add(obj)
+
+  def add(self, obj):
+    self.where[obj] = (obj.x, obj.y)
+    self.cells.setdefault((obj.x, obj.y), []).append(obj)
+    if obj.blocks:
+      self.map.occupy(obj.x, obj.y, 1)
+
+  def remove(self, obj):
+    cell = self.where.pop(obj)
+    self.cells[cell].remove(obj)
+    if not self.cells[cell]:
+      del self.cells[cell]
+    if obj.blocks:
+      self.map.occupy(cell[0], cell[1], -1)
+
+  def set_blocks(self, obj, blocks):
+    #change whether an object blocks movement
+    if obj in self.where and obj.blocks != blocks:
+      (x, y) = self.where[obj]
+      self.map.occupy(x, y, 1 if blocks else -1)
+    obj.blocks = blocks
+
+  def move(self, obj):
+    #refile an object after its x and y have changed
+    if self.where.get(obj) != (obj.x, obj.y):
+      self.remove(obj)
+      self.add(obj)
+
+  def at(self, x, y):
+    #the objects on a cell
+    return list(self.cells.get((x, y), ()))
+
+  def in_radius(self, x, y, radius):
+    #the objects within a (euclidean) distance of a position
+    r = int(radius)
+    if (2 * r + 1) ** 2 > len(self.where):
+      #fewer objects than cells to look at. (Not by going through where: it is keyed on the objects, so its
+      #order changes from run to run, and the order objects are found in decides the order enemies act in.)
+      return [obj for objs in self.cells.values() for obj in objs if obj.distance(x, y) <= radius]
+    found = []
+    for cx in range(x - r, x + r + 1):
+      for cy in range(y - r, y + r + 1):
+        for obj in self.cells.get((cx, cy), ()):
+          if obj.distance(x, y) <= radius:
+            found.append(obj)
+    return found
+
+#################################################################################################################################
+
+class FlowField:
+  # The number of moves (in any of the 8 directions) from every walkable tile within radius of a target to the
+  # target, found with a breadth-first search done a whole ring at a time with array operations. It is built
+  # once for the player's position and shared, so each chasing enemy only has to look at its neighbours to
+  # find the next step towards the player, however many of them there are.
+  UNREACHED = np.iinfo(np.int32).max
+  NEIGHBOURS = [(-1, -1), (0, -1), (1, -1), (-1, 0), (1, 0), (-1, 1), (0, 1), (1, 1)]
+
+  def __init__(self, radius=FLOW_FIELD_RADIUS):
+    self.radius = radius
+    self.map = None
+    self.target = None
+    self.origin = (0, 0)
+    self.distance = np.zeros((0, 0), dtype=np.int32)
+
+  def invalidate(self):
+    #forget the field (e.g. after the terrain changed) so that the next update rebuilds it
+    self.map = None
+
+  def update(self, tile_map, x, y):
+    #make sure the field leads to (x, y) on tile_map, rebuilding it only if the target or map has changed
+    if tile_map is self.map and (x, y) == self.target:
+      return
+    (self.map, self.target) = (tile_map, (x, y))
+    (x0, y0) = (max(x - self.radius, 0), max(y - self.radius, 0))
+    (x1, y1) = (min(x + self.radius + 1, tile_map.width), min(y + self.radius + 1, tile_map.height))
+    self.origin = (x0, y0)
+    walkable = ~tile_map.blocked[x0:x1, y0:y1]
+    distance = np.empty(walkable.shape, dtype=np.int32)
+    distance.fill(FlowField.UNREACHED)
+    frontier = np.zeros(walkable.shape, dtype=bool)
+    frontier[x - x0, y - y0] = True
+    distance[frontier] = 0
+    steps = 0
+    while frontier.any():
+      steps += 1
+      #grow the frontier by one tile in every direction (across then down, which covers the diagonals)
+      grown = frontier.copy()
+      grown[1:, :] |= frontier[:-1, :]
+      grown[:-1, :] |= frontier[1:, :]
+      across = grown.copy()
+      grown[:, 1:] |= across[:, :-1]
+      grown[:, :-1] |= across[:, 1:]
+      frontier = grown & walkable & (distance == FlowField.UNREACHED)
+      distance[frontier] = steps
+    self.distance = distance
+
+  def step_from(self, x, y):
+    #the (dx, dy) that takes something at (x, y) closest to the target onto a tile it can move to, or None if
+    #(x, y) is outside the field, cut off from the target or there is nowhere better to go
+    (ox, oy) = self.origin
+    (width, height) = self.distance.shape
+    if not (0 <= x - ox < width and 0 <= y - oy < height):
+      return None
+    best = self.distance[x - ox, y - oy]
+    step = None
+    for (dx, dy) in FlowField.NEIGHBOURS:
+      (lx, ly) = (x + dx - ox, y + dy - oy)
+      if 0 <= lx < width and 0 <= ly < height and self.distance[lx, ly] < best and not is_blocked(x + dx, y + dy):
+        (best, step) = (self.distance[lx, ly], (dx, dy))
+    return step
+
+#################################################################################################################################
+
+class PathCache:
+  # A* paths (see find_path) for enemies that hunt the player, kept from turn to turn so that each hunter only
+  # works out a new one when it has to: when the player has moved more than tolerance tiles from where its
+  # path leads, when the path is used up or the next step is blocked, when the terrain changes somewhere along
+  # it (cell_changed), or when the generation moves on (on entering or loading a level).
+  def __init__(self, tolerance=PATH_TOLERANCE):
+    self.tolerance = tolerance
+    self.generation = 0
+    self.paths = {}  #object -> (generation, destination, deque of the tiles left to walk)
+    self.through = {}  #(x, y) -> objects whose path goes through that tile
+
+  def new_generation(self):
+    self.generation += 1
+    self.paths.clear()
+    self.through.clear()
+
+  def cell_changed(self, x, y):
+    #drop just the paths that go through a tile that has changed
+    for obj in list(self.through.get((x, y), ())):
+      self.forget(obj)
+
+  def forget(self, obj):
+    cached = self.paths.pop(obj, None)
+    if cached is not None:
+      for cell in cached[2]:
+        self.leave(obj, cell)
+
+  def leave(self, obj, cell):
+    #obj's path no longer goes through cell
+    objs = self.through.get(cell)
+    if objs is not None:
+      objs.discard(obj)
+      if not objs:
+        del self.through[cell]
+
+  def next_step(self, obj, x, y):
+    #the tile obj should move onto next on its way to (x, y), or None if it cannot find a way there
+    cached = self.paths.get(obj)
+    if cached is not None:
+      (generation, (dest_x, dest_y), steps) = cached
+      #(obj may have been moved off its path, e.g. while confused, in which case the next step is not next to it)
+      if (generation != self.generation or max(abs(dest_x - x), abs(dest_y - y)) > self.tolerance or
+          not steps or max(abs(steps[0][0] - obj.x), abs(steps[0][1] - obj.y)) != 1 or
+          is_blocked(steps[0][0], steps[0][1])):
+        self.forget(obj)
+        cached = None
+    if cached is None:
+      steps = find_path(obj.x, obj.y, x, y)
+      if not steps:
+        return None
+      steps = collections.deque(steps)
+      self.paths[obj] = (self.generation, (x, y), steps)
+      for cell in steps:
+        self.through.setdefault(cell, set()).add(obj)
+    step = steps.popleft()
+    self.leave(obj, step)
+    return step
+
+#################################################################################################################################
+
+class Scheduler:
+  # Decides which AIs act and when. Awake actors wait in a heap keyed on the tick of their next action, and each
+  # player turn (ACTION_COST ticks) the ones due are popped, act and go back in after a gap that depends on
+  # their speed, so a fast enemy can get two moves in some turns and a slow one misses some. Anything with an
+  # AI that is not in the heap is asleep and costs nothing; actors near the player are woken at the start of
+  # every turn, as are any that heard a noise (see NoiseMap; wake can also be called directly), so the cost of
+  # a turn follows the number of awake actors rather than the number on the level.
+  def __init__(self):
+    self.reset()
+
+  def reset(self):
+    #put everything to sleep, e.g. for a new level
+    self.time = 0
+    self.queue = []  #heap of (tick of next action, order it went in, object)
+    self.order = 0
+    self.awake = set()
+
+  def wake_all(self, objs):
+    #wake actors in the order they are in objects rather than the order they were found in, so that the same
+    #game always plays out the same way (the order they are woken in decides who acts first in a tick)
+    for obj in sorted((obj for obj in objs if obj.ai and obj not in self.awake), key=objects.index):
+      self.wake(obj)
+
+  def wake(self, obj, delay=0):
+    #wake an actor up, to act delay ticks from the start of this turn
+    if obj.ai is None or obj in self.awake:
+      return
+    self.awake.add(obj)
+    self.push(obj, self.time + delay)
+
+  def push(self, obj, time):
+    self.order += 1
+    heapq.heappush(self.queue, (time, self.order, obj))
+
+  def gap(self, obj):
+    #the ticks between an actor's actions
+    speed = getattr(obj.fighter, 'speed', NORMAL_SPEED) if obj.fighter else NORMAL_SPEED
+    return max(1, ACTION_COST * NORMAL_SPEED // speed)
+
+  def should_sleep(self, obj, x, y):
+    return obj.distance(x, y) > SLEEP_RADIUS and not getattr(obj.ai, 'hunting', False)
+
+  def run_turn(self, x, y):
+    #let the awake actors act until the player (at (x, y)) is next due to
+    self.wake_all(object_index.in_radius(x, y, WAKE_RADIUS))
+    self.wake_all(noise_map.listeners())
+    end = self.time + ACTION_COST
+    while self.queue and self.queue[0][0] < end:
+      (time, order, obj) = heapq.heappop(self.queue)
+      if obj.ai is None or self.should_sleep(obj, x, y):
+        #dead (or otherwise done with), or too far away to matter
+        self.awake.discard(obj)
+        continue
+      obj.ai.take_turn()
+      self.push(obj, time + self.gap(obj))
+    self.time = end
+
+#################################################################################################################################
+
+class NoiseMap:
+  # How loud it is on each tile this turn. Noises (a fight, an explosion...) are made during a turn and spread
+  # out together at the start of the next one (propagate): a noise of loudness n is heard at n - 1 on the tiles
+  # next to it, n - 2 a step further and so on, around walls rather than through them. The spreading is done a
+  # step at a time over the whole affected area with array operations, and then any enemy can tell whether it
+  # heard something, and which way it came from, by looking at its own and its neighbours' tiles.
+  def __init__(self):
+    self.clear()
+
+  def clear(self):
+    self.pending = []  #(x, y, loudness) of the noises made since the last propagate
+    self.sources = []
+    self.origin = (0, 0)
+    self.level = np.zeros((0, 0), dtype=int)
+
+  def make(self, x, y, loudness):
+    self.pending.append((x, y, loudness))
+
+  def propagate(self, tile_map):
+    #spread the noises made since last time over tile_map, replacing the last turn's
+    (self.sources, self.pending) = (self.pending, [])
+    if not self.sources:
+      self.level = np.zeros((0, 0), dtype=int)
+      return
+    x0 = max(min(x - loudness for (x, y, loudness) in self.sources), 0)
+    y0 = max(min(y - loudness for (x, y, loudness) in self.sources), 0)
+    x1 = min(max(x + loudness + 1 for (x, y, loudness) in self.sources), tile_map.width)
+    y1 = min(max(y + loudness + 1 for (x, y, loudness) in self.sources), tile_map.height)
+    self.origin = (x0, y0)
+    walkable = ~tile_map.blocked[x0:x1, y0:y1]
+    level = np.zeros((x1 - x0, y1 - y0), dtype=int)
+    for (x, y, loudness) in self.sources:
+      level[x - x0, y - y0] = max(level[x - x0, y - y0], loudness)
+    for step in range(max(loudness for (x, y, loudness) in self.sources) - 1):
+      #the loudest of each tile's neighbours, one quieter (across then down, which covers the diagonals)
+      across = level.copy()
+      across[1:, :] = np.maximum(across[1:, :], level[:-1, :])
+      across[:-1, :] = np.maximum(across[:-1, :], level[1:, :])
+      spread = across.copy()
+      spread[:, 1:] = np.maximum(spread[:, 1:], across[:, :-1])
+      spread[:, :-1] = np.maximum(spread[:, :-1], across[:, 1:])
+      louder = np.maximum(level, np.where(walkable, spread - 1, 0))
+      if (louder == level).all():
+        break
+      level = louder
+    self.level = level
+
+  def heard(self, x, y):
+    #how loud it is at (x, y) (0 for silence)
+    (x, y) = (x - self.origin[0], y - self.origin[1])
+    if 0 <= x < self.level.shape[0] and 0 <= y < self.level.shape[1]:
+      return self.level[x, y]
+    return 0
+
+  def step_towards(self, x, y):
+    #the (dx, dy) onto the loudest free tile next to (x, y), if it is louder than (x, y) itself
+    best = self.heard(x, y)
+    step = None
+    for (dx, dy) in FlowField.NEIGHBOURS:
+      level = self.heard(x + dx, y + dy)
+      if level > best and not is_blocked(x + dx, y + dy):
+        (best, step) = (level, (dx, dy))
+    return step
+
+  def listeners(self):
+    #everything with an AI that can hear this turn's noises, in the order they are in objects
+    found = set()
+    for (x, y, loudness) in self.sources:
+      for obj in object_index.in_radius(x, y, loudness):
+        if obj.ai and self.heard(obj.x, obj.y) > 0:
+          found.add(obj)
+    return sorted(found, key=objects.index)
+
+#################################################################################################################################
+
+class MapRenderer:
+  # Keeps the last frame drawn to an offscreen console (the glyph, foreground and background of every cell)
+  # so that each new frame only sends the cells that changed to libtcod.
+  # If more than BULK_FRACTION of the console changed it is cheaper to refill the whole thing at once.
+  BULK_FRACTION = 0.25
+
+  def __init__(self, console):
+    self.console = console
+    self.width = libtcod.console_get_width(console)
+    self.height = libtcod.console_get_height(console)
+    self.scratch = libtcod.console_new(self.width, self.height)
+    #the frame currently on the console
+    self.glyph = np.zeros((self.width, self.height), dtype=int)
+    self.fg = np.zeros((self.width, self.height, 3), dtype=int)
+    self.bg = np.zeros((self.width, self.height, 3), dtype=int)
+    #the frame being built, starting from the tile colours
+    self.background = np.zeros((self.width, self.height, 3), dtype=int)
+    self.next_glyph = self.glyph.copy()
+    self.next_fg = self.fg.copy()
+    self.next_bg = self.bg.copy()
+    self.invalidate()
+
+  def invalidate(self):
+    #forget what is on the console so that the next frame is drawn in full
+    self.glyph[:] = -1
+
+  def scroll(self, dx, dy):
+    #the view moved by (dx, dy): shift what is already on the console (and our record of it) the other way
+    #by blitting it through a scratch console, leaving only the newly exposed strip to be drawn by present()
+    if abs(dx) >= self.width or abs(dy) >= self.height:
+      self.invalidate()
+      return
+    (w, h) = (self.width - abs(dx), self.height - abs(dy))
+    (sx, sy) = (max(dx, 0), max(dy, 0))
+    (tx, ty) = (max(-dx, 0), max(-dy, 0))
+    libtcod.console_blit(self.console, sx, sy, w, h, self.scratch, tx, ty)
+    libtcod.console_blit(self.scratch, 0, 0, self.width, self.height, self.console, 0, 0)
+    for layer in (self.glyph, self.fg, self.bg):
+      kept = layer[sx:sx + w, sy:sy + h].copy()
+      layer[:] = -1
+      layer[tx:tx + w, ty:ty + h] = kept
+
+  def set_background(self, rgb):
+    #set the tile colours that every following frame is drawn on top of
+    self.background[:] = rgb
+
+  def begin(self):
+    #start a new frame: blank glyphs on top of the tile colours
+    self.next_glyph[:] = ord(' ')
+    self.next_fg[:] = tuple(libtcod.white)
+    self.next_bg[:] = self.background
+
+  def put_chars(self, xs, ys, glyphs, colours):
+    #draw a batch of glyph codes with their (n, 3) foreground colours; where several land
+    #on the same cell the one that comes last wins
+    cells = xs * self.height + ys
+    last = len(xs) - 1 - np.unique(cells[::-1], return_index=True)[1]
+    self.next_glyph[xs[last], ys[last]] = glyphs[last]
+    self.next_fg[xs[last], ys[last]] = colours[last]
+
+  def present(self):
+    #send the cells that differ from the last frame to the console, and return how many there were
+    changed = (self.next_glyph != self.glyph) | (self.next_fg != self.fg).any(2) | (self.next_bg != self.bg).any(2)
+    (xs, ys) = np.nonzero(changed)
+    if len(xs) > self.BULK_FRACTION * self.width * self.height:
+      #the console expects its cells row by row
+      libtcod.console_fill_char(self.console, self.next_glyph.T.ravel())
+      libtcod.console_fill_foreground(self.console, *(self.next_fg[:, :, i].T.ravel() for i in range(3)))
+      libtcod.console_fill_background(self.console, *(self.next_bg[:, :, i].T.ravel() for i in range(3)))
+    else:
+      for (x, y) in zip(xs, ys):
+        fore = libtcod.Color(*self.next_fg[x, y])
+        back = libtcod.Color(*self.next_bg[x, y])
+        libtcod.console_put_char_ex(self.console, int(x), int(y), int(self.next_glyph[x, y]), fore, back)
+    #the new frame is now the one on the console
+    (self.glyph, self.next_glyph) = (self.next_glyph, self.glyph)
+    (self.fg, self.next_fg) = (self.next_fg, self.fg)
+    (self.bg, self.next_bg) = (self.next_bg, self.bg)
+    return len(xs)
+
+#################################################################################################################################
+
+class WindowPool:
+  # Offscreen consoles for menu windows, kept by size so that opening a menu reuses a console rather than
+  # allocating a new native one every time. Consoles stay in the pool until clear() deletes them.
+  def __init__(self):
+    self.free = {}  #(width, height) -> consoles not currently in use
+
+  def acquire(self, width, height):
+    #a blank console of the given size
+    consoles = self.free.get((width, height))
+    if not consoles:
+      return libtcod.console_new(width, height)
+    window = consoles.pop()
+    libtcod.console_set_default_background(window, libtcod.black)
+    libtcod.console_clear(window)
+    return window
+
+  def release(self, window):
+    #hand a console back for reuse
+    size = (libtcod.console_get_width(window), libtcod.console_get_height(window))
+    self.free.setdefault(size, []).append(window)
+
+  def clear(self):
+    #delete every pooled console
+    for consoles in self.free.values():
+      for window in consoles:
+        libtcod.console_delete(window)
+    self.free = {}
+
+#################################################################################################################################
+
+class LevelCache:
+  # Snapshots of the levels the player has left, by archive depth, so that going back to one restores it as it
+  # was rather than generating a new one. Each snapshot is a zlib-compressed pickle; the most recently visited
+  # are kept in memory up to max_bytes in total and the rest are spilled to disk (a chunked map's tiles are
+  # already in its ChunkStore file, so its snapshot is small). The spilled files are only for while the game
+  # runs: a save holds every snapshot itself.
+  def __init__(self, seed=0, max_bytes=LEVEL_CACHE_BYTES):
+    self.seed = seed  #the game's seed, which the files are named by
+    self.max_bytes = max_bytes
+    self.snapshots = collections.OrderedDict()  #depth -> compressed snapshot, least recently visited first
+    self.size = 0
+    self.spilled = set()  #depths whose snapshot is on disk
+
+  def __contains__(self, depth):
+    return depth in self.snapshots or depth in self.spilled
+
+  def path(self, depth):
+    return LEVEL_SNAPSHOT_PATH % (self.seed, depth)
+
+  def put(self, depth, level):
+    self.drop_snapshot(depth)
+    data = zlib.compress(pickle.dumps(level, 2))
+    self.snapshots[depth] = data
+    self.size += len(data)
+    #spill the least recently visited levels until the rest fit (always keeping the newest in memory)
+    while self.size > self.max_bytes and len(self.snapshots) > 1:
+      self.spill(next(iter(self.snapshots)))
+
+  def take(self, depth):
+    #remove a level from the cache and return it
+    if depth in self.snapshots:
+      data = self.snapshots.pop(depth)
+      self.size -= len(data)
+    else:
+      data = self.read(depth)
+      self.drop_snapshot(depth)
+    return pickle.loads(zlib.decompress(data))
+
+  def read(self, depth):
+    with open(self.path(depth), 'rb') as f:
+      return f.read()
+
+  def spill(self, depth):
+    data = self.snapshots.pop(depth)
+    self.size -= len(data)
+    with open(self.path(depth), 'wb') as f:
+      f.write(data)
+    self.spilled.add(depth)
+
+  def drop_snapshot(self, depth):
+    if depth in self.snapshots:
+      self.size -= len(self.snapshots.pop(depth))
+    if depth in self.spilled:
+      self.spilled.remove(depth)
+      os.remove(self.path(depth))
+
+  def discard(self, depth):
+    #drop a level for good, along with the ChunkStore file its tiles are in if it has one
+    self.drop_snapshot(depth)
+    if os.path.exists(LEVEL_STORE_PATH % (self.seed, depth)):
+      os.remove(LEVEL_STORE_PATH % (self.seed, depth))
+
+  def clear(self):
+    for depth in list(self.snapshots) + list(self.spilled):
+      self.discard(depth)
+
+  def __getstate__(self):
+    #when pickled (see save_game) the spilled snapshots are read back in, so the save does not depend on files
+    #that a later game may delete. (The cache itself is left as it is: the game may carry on after saving)
+    #(the spilled levels were all visited before the ones in memory)
+    snapshots = collections.OrderedDict((depth, self.read(depth)) for depth in sorted(self.spilled))
+    snapshots.update(self.snapshots)
+    state = self.__dict__.copy()
+    state.update(snapshots=snapshots, size=sum(len(data) for data in snapshots.values()), spilled=set())
+    return state
+
+  def __setstate__(self, state):
+    #spill what does not fit again on loading
+    self.__dict__.update(state)
+    while self.size > self.max_bytes and len(self.snapshots) > 1:
+      self.spill(next(iter(self.snapshots)))
+
+#################################################################################################################################
+
+class FrameTimer:
+  # Times each phase of the main loop and keeps the last HISTORY samples of every phase (in milliseconds),
+  # so we can see whether a slow frame came from FOV, drawing or AI without attaching a profiler.
+  # BUCKETS are the upper bounds of the histogram bins, anything slower goes in a final overflow bin.
+  HISTORY = 600
+  BUCKETS = [1, 2, 4, 8, 16, 32, 64]
+
+  def __init__(self):
+    self.frame = 0
+    self.show_overlay = False
+    self.phases = []  #phase names, in the order they were first timed
+    self.samples = {}  #phase name -> deque of (frame, ms)
+
+  def next_frame(self):
+    self.frame += 1
+
+  @contextlib.contextmanager
+  def phase(self, name):
+    #time the body of a "with" block as one sample of the named phase
+    start = timeit.default_timer()
+    try:
+      yield
+    finally:
+      self.record(name, (timeit.default_timer() - start) * 1000.0)
+
+  def record(self, name, ms):
+    if name not in self.samples:
+      self.phases.append(name)
+      self.samples[name] = collections.deque(maxlen=self.HISTORY)
+    self.samples[name].append((self.frame, ms))
+
+  def stats(self, name):
+    #mean, 95th percentile and worst time of a phase over the rolling window
+    times = sorted(ms for (frame, ms) in self.samples[name])
+    return (sum(times) / len(times), times[int(len(times) * 0.95)], times[-1])
+
+  def histogram(self, name):
+    #the number of samples of a phase in each bucket over the rolling window
+    times = [ms for (frame, ms) in self.samples[name]]
+    return np.bincount(np.searchsorted(self.BUCKETS, times), minlength=len(self.BUCKETS) + 1).tolist()
+
+  def draw_overlay(self, console, x, y):
+    #print the mean/95th percentile/worst time of every phase, one line each
+    libtcod.console_set_default_foreground(console, libtcod.light_yellow)
+    libtcod.console_print_ex(console, x, y, libtcod.BKGND_SET, libtcod.RIGHT, '%-12s %5s %5s %5s' % ('phase', 'mean', 'p95', 'max'))
+    for name in self.phases:
+      y += 1
+      line = '%-12s %5.1f %5.1f %5.1f' % ((name,) + self.stats(name))
+      libtcod.console_print_ex(console, x, y, libtcod.BKGND_SET, libtcod.RIGHT, line)
+
+  def dump(self, path):
+    #write the rolling window of raw samples to <path>.csv and a summary of every phase to <path>.json
+    with open(path + '.csv', 'w') as csv_file:
+      writer = csv.writer(csv_file)
+      writer.writerow(['frame', 'phase', 'ms'])
+      for name in self.phases:
+        for (frame, ms) in self.samples[name]:
+          writer.writerow([frame, name, '%.3f' % ms])
+    summary = {'frames': self.frame, 'buckets_ms': self.BUCKETS, 'phases': {}}
+    for name in self.phases:
+      (mean, p95, worst) = self.stats(name)
+      summary['phases'][name] = {'mean': mean, 'p95': p95, 'max': worst, 'histogram': self.histogram(name)}
+    with open(path + '.json', 'w') as json_file:
+      json.dump(summary, json_file, indent=2, sort_keys=True)
+
 #################################################################################################################################
 #################################################################################################################################
 
@@ -347,8 +1370,8 @@ def closest_enemy(max_range):
   #find closest enemy, up to a maximum range, and in the player's FOV
   closest_so_far = None
   closest_dist = max_range + 1  #start with (slightly more than) maximum range
-  for object in objects:
-    if object.fighter and not object == player and libtcod.map_is_in_fov(fov_map, object.x, object.y):
+  for object in object_index.in_radius(player.x, player.y, max_range):
+    if object.fighter and not object == player and in_fov(object.x, object.y):
       #calculate distance between this object and the player
       dist = player.distance_to(object)
       if dist < closest_dist:  #it's closer, so remember it
@@ -376,7 +1399,7 @@ def cast_shock():
     return 'cancelled'
   #zap it!
   message('A burst of static electricity strikes the ' + enemy.name + ' for ' + str(SHOCK_DAMAGE) + ' points of damage!', libtcod.light_blue)
-  enemy.fighter.take_damage(SHOCK_DAMAGE)
+  enemy.fighter.take_damage(SHOCK_DAMAGE, 'shock')
 
 #################################################################################################################################
 
@@ -400,11 +1423,12 @@ def grenado():
     (x, y) = target_tile()
     if x is None: return 'cancelled'
     message('The grenado explodes, throwing shrapnel over ' + str(GRENADO_RADIUS) + ' tiles!', libtcod.orange)
+    noise_map.make(x, y, GRENADO_NOISE)
 
-    for obj in objects:  #damage every fighter in range, including the player
-        if obj.distance(x, y) <= GRENADO_RADIUS and obj.fighter:
+    for obj in object_index.in_radius(x, y, GRENADO_RADIUS):  #damage every fighter in range, including the player
+        if obj.fighter:
             message('The ' + obj.name + ' gets scorched for ' + str(GRENADO_DAMAGE) + ' damage.', libtcod.orange)
-            obj.fighter.take_damage(GRENADO_DAMAGE)
+            obj.fighter.take_damage(GRENADO_DAMAGE, 'grenado')
 
 #################################################################################################################################
 #################################################################################################################################
@@ -419,7 +1443,7 @@ def grenado():
 
 class Fighter:
   # This component contains combat-related properties and methods (for enemies, player, NPCs).
-  def __init__(self, hp, defense, power, xp, sp=0, death_function=None):
+  def __init__(self, hp, defense, power, xp, sp=0, death_function=None, speed=NORMAL_SPEED):
     self.base_max_hp = hp
     self.hp = hp
     self.base_defense = defense
@@ -428,6 +1452,8 @@ class Fighter:
     self.base_max_sp = sp
     self.sp = sp
     self.death_function = death_function
+    self.speed = speed  #how many turns it gets for every NORMAL_SPEED turns, in percent
+    self.killed_by = None
 
   @property
   def power(self):  #return actual power, by summing up the bonuses from all equipped items
@@ -449,12 +1475,13 @@ class Fighter:
     bonus = sum(equipment.max_sp_bonus for equipment in get_all_equipped(self.owner))
     return self.base_max_sp + bonus
 
-  def take_damage(self, damage):
+  def take_damage(self, damage, cause=None):
     #apply damage if possible
     if damage > 0:
       self.hp -= damage
     #check for death. if there's a death function, call it
     if self.hp <= 0:
+      self.killed_by = cause  #(whoever or whatever did the damage, if known)
       function = self.death_function
       if function is not None:
         function(self.owner)
@@ -462,12 +1489,14 @@ class Fighter:
         player.fighter.xp += self.xp
 
   def attack(self, target):
+    #fighting is noisy
+    noise_map.make(self.owner.x, self.owner.y, ATTACK_NOISE)
     #a simple formula for attack damage
     damage = self.power - target.fighter.defense
     if damage > 0:
       #make the target take some damage
       message(self.owner.name.capitalize() + ' attacks ' + target.name + ' for ' + str(damage) + ' hit points.')
-      target.fighter.take_damage(damage)
+      target.fighter.take_damage(damage, self.owner.name)
     else:
       message(self.owner.name.capitalize() + ' attacks ' + target.name + ' but it has no effect!')
 
@@ -484,13 +1513,52 @@ class BasicEnemy:
   def take_turn(self):
     #a basic enemy takes its turn. If you can see it, it can see you
     enemy = self.owner
-    if libtcod.map_is_in_fov(fov_map, enemy.x, enemy.y):
-    #move towards player if far away
+    if in_fov(enemy.x, enemy.y):
+    #move towards player if far away, following the flow field (which is only rebuilt when the player has moved)
       if enemy.distance_to(player) >= 2:
-        enemy.move_towards(player.x, player.y)
+        flow_field.update(map, player.x, player.y)
+        step = flow_field.step_from(enemy.x, enemy.y)
+        if step is not None:
+          enemy.move(*step)
+        else:
+          enemy.move_towards(player.x, player.y)
       #close enough, attack! (if the player is still alive.)
       elif player.fighter.hp > 0:
         enemy.fighter.attack(player)
+    elif noise_map.heard(enemy.x, enemy.y) > 0:
+      #heard something: go and see what it was
+      step = noise_map.step_towards(enemy.x, enemy.y)
+      if step is not None:
+        enemy.move(*step)
+
+#################################################################################################################################
+
+class HunterEnemy:
+  #AI for an enemy that, once it has seen (or heard) the player, keeps after them by the shortest path even out of sight
+  def __init__(self):
+    self.hunting = False
+    self.lost_for = 0  #turns since it last saw or heard the player
+
+  def take_turn(self):
+    enemy = self.owner
+    if in_fov(enemy.x, enemy.y) or noise_map.heard(enemy.x, enemy.y) > 0:
+      (self.hunting, self.lost_for) = (True, 0)
+    elif self.hunting:
+      self.lost_for += 1
+      if self.lost_for > HUNT_TURNS:
+        #lost the trail, so give up (and let it fall asleep) until the player turns up again
+        self.hunting = False
+        path_cache.forget(enemy)
+    if not self.hunting:
+      return
+    if enemy.distance_to(player) >= 2:
+      step = path_cache.next_step(enemy, player.x, player.y)
+      if step is not None:
+        enemy.move(step[0] - enemy.x, step[1] - enemy.y)
+      else:
+        enemy.move_towards(player.x, player.y)
+    elif player.fighter.hp > 0:
+      enemy.fighter.attack(player)
 
 #################################################################################################################################
 
@@ -503,7 +1571,7 @@ class ConfusedEnemy:
   def take_turn(self):
     if self.num_turns > 0:  #still confused...
       #move in a random direction, and decrease the number of turns confused
-      self.owner.move(libtcod.random_get_int(0, -1, 1), libtcod.random_get_int(0, -1, 1))
+      self.owner.move(libtcod.random_get_int(streams['ai'], -1, 1), libtcod.random_get_int(streams['ai'], -1, 1))
       self.num_turns -= 1
     else:  #restore the previous AI (this one will be deleted because it's not referenced anymore)
       self.owner.ai = self.old_ai
@@ -537,7 +1605,8 @@ def enemy_death(enemy):
   message('The ' + enemy.name + ' was defeated! You gain ' + str(enemy.fighter.xp) + ' experience points.', libtcod.orange)
   enemy.char = '%'
   enemy.colour = libtcod.dark_red
-  enemy.blocks = False
+  object_index.set_blocks(enemy, False)
+  path_cache.forget(enemy)
   enemy.fighter = None
   enemy.ai = None
   enemy.name = 'remains of ' + enemy.name
@@ -561,6 +1630,10 @@ def handle_keys():
     libtcod.console_set_fullscreen(not libtcod.console_is_fullscreen())
   elif key.vk == libtcod.KEY_ESCAPE:
     return 'exit'  #exit game
+  elif key.vk == libtcod.KEY_F3:
+    #F3: toggle the frame timing overlay
+    frame_timer.show_overlay = not frame_timer.show_overlay
+    return 'didnt-take-turn'
 
   #Check that the player is alive!
   if game_state == 'playing':
@@ -602,8 +1675,8 @@ def handle_keys():
       key_char = chr(key.c)
       if key_char == 'g':
         #pick up an item
-        for object in objects:  #look for an item in the player's tile
-          if object.x == player.x and object.y == player.y and object.item:
+        for object in object_index.at(player.x, player.y):  #look for an item in the player's tile
+          if object.item:
             object.item.pick_up()
             #break
 
@@ -646,7 +1719,7 @@ def get_names_under_mouse():
   (x, y) = (mouse.cx, mouse.cy)
   (x, y) = (camera_x + x, camera_y + y)
   #create a list with the names of all objects at the mouse's coordinates and in FOV
-  names = [obj.name for obj in objects if obj.x == x and obj.y == y and libtcod.map_is_in_fov(fov_map, obj.x, obj.y)]
+  names = [obj.name for obj in object_index.at(x, y) if in_fov(obj.x, obj.y)]
   names = ', '.join(names)  #join the names, separated by commas
   return names
 
@@ -663,7 +1736,7 @@ def target_tile(max_range=None):
     (x, y) = (mouse.cx, mouse.cy)
     (x, y) = (camera_x + x, camera_y + y)
     #accept the target if the player clicked in FOV, and in case a range is specified, if it's in that range
-    if (mouse.lbutton_pressed and libtcod.map_is_in_fov(fov_map, x, y) and (max_range is None or player.distance(x, y) <= max_range)):
+    if (mouse.lbutton_pressed and in_fov(x, y) and (max_range is None or player.distance(x, y) <= max_range)):
       return (x, y)
 
     if mouse.rbutton_pressed or key.vk == libtcod.KEY_ESCAPE:
@@ -679,14 +1752,14 @@ def target_enemy(max_range=None):
     if x is None:  #player cancelled
       return None
     #return the first clicked enemy, otherwise continue looping
-    for obj in objects:
-      if obj.x == x and obj.y == y and obj.fighter and obj != player:
+    for obj in object_index.at(x, y):
+      if obj.fighter and obj != player:
         return obj
 
 ##########################################################################################################################
 
 def move_camera(target_x, target_y):
-  global camera_x, camera_y, fov_recompute
+  global camera_x, camera_y
 
   #new camera coordinates (top-left corner of the screen relative to the map)
   x = target_x - CAMERA_WIDTH / 2  #coordinates so that the target is at the center of the screen
@@ -695,9 +1768,8 @@ def move_camera(target_x, target_y):
   #make sure the camera doesn't see outside the map
   if x < 0: x = 0
   if y < 0: y = 0
-  if x > MAP_WIDTH - CAMERA_WIDTH - 1: x = MAP_WIDTH - CAMERA_WIDTH - 1
-  if y > MAP_HEIGHT - CAMERA_HEIGHT - 1: y = MAP_HEIGHT - CAMERA_HEIGHT - 1
-  if x != camera_x or y != camera_y: fov_recompute = True
+  if x > map.width - CAMERA_WIDTH - 1: x = map.width - CAMERA_WIDTH - 1
+  if y > map.height - CAMERA_HEIGHT - 1: y = map.height - CAMERA_HEIGHT - 1
   (camera_x, camera_y) = (x, y)
 
 ##########################################################################################################################
@@ -712,48 +1784,57 @@ def to_camera_coordinates(x, y):
 ##########################################################################################################################
 
 def render_all():
-  global fov_map, color_dark_wall, color_light_wall
-  global color_dark_ground, color_light_ground
-  global fov_recompute
-  global camera_x, camera_y
+  (old_x, old_y) = (camera_x, camera_y)
+  # Follow the player and recompute FOV if needed (the player moved or something)
+  tiles_stale = update_view()
+  if (camera_x, camera_y) != (old_x, old_y):
+    # Reuse what is already drawn for the part of the view that is still on screen
+    map_renderer.scroll(camera_x - old_x, camera_y - old_y)
+    tiles_stale = True
+  if tiles_stale:
+    with frame_timer.phase('render.tiles'):
+      map_renderer.set_background(render_tiles())
+
+  # Draw all objects in the list (the player last so it is always on top) and
+  # send whatever changed since the last frame to "con"
+  with frame_timer.phase('render.objects'):
+    map_renderer.begin()
+    render_objects()
+    map_renderer.present()
+
+  # Blit the contents of the offscreen "con" buffer (which is the size of the camera view) to the root console
+  libtcod.console_blit(con, 0, 0, CAMERA_WIDTH, CAMERA_HEIGHT, 0, 0, 0)
+  with frame_timer.phase('render.panel'):
+    render_panel()
+
+##########################################################################################################################
 
+def update_view():
+  #move the camera (and the FOV window with it, if it has to) to follow the player and recompute the FOV if
+  #anything has changed, returning whether it was. This is the part of drawing a frame that the game itself
+  #depends on (the AI looks at the FOV), so simulate_game calls it instead of render_all
+  global fov_recompute
   move_camera(player.x, player.y)
+  if not fov_window_covers(camera_x, camera_y, camera_x + CAMERA_WIDTH, camera_y + CAMERA_HEIGHT):
+    load_fov_window()
+  if not fov_recompute:
+    return False
+  fov_recompute = False
+  with frame_timer.phase('render.fov'):
+    libtcod.map_compute_fov(fov_map, player.x - fov_origin[0], player.y - fov_origin[1], TORCH_RADIUS, FOV_LIGHT_WALLS, FOV_ALGO)
+  return True
+
+##########################################################################################################################
+
+def render_panel():
+  #the GUI panel is retained: it is only redrawn (and blitted to the root console) when something on it changed
+  global panel_state
+  names = get_names_under_mouse()
+  state = (game_msgs_version, player.fighter.hp, player.fighter.max_hp, player.fighter.sp, player.fighter.max_sp, archive_depth, names)
+  if state == panel_state:
+    return
+  panel_state = state
 
-  if fov_recompute:
-  # Recompute FOV if needed (the player moved or something)
-    fov_recompute = False
-    libtcod.map_compute_fov(fov_map, player.x, player.y, TORCH_RADIUS, FOV_LIGHT_WALLS, FOV_ALGO)
-    libtcod.console_clear(con)
-  # Go through all tiles, and set their background color according to the FOV
-    for y in range(CAMERA_HEIGHT):
-      for x in range(CAMERA_WIDTH):
-        (map_x, map_y) = (camera_x + x, camera_y + y)
-        visible = libtcod.map_is_in_fov(fov_map, map_x, map_y)
-        wall = map[map_x][map_y].block_sight
-        if not visible:
-          # It's out of the player's FOV
-          if map[map_x][map_y].explored:
-            if wall:
-              libtcod.console_set_char_background(con, x, y, color_dark_wall, libtcod.BKGND_SET)
-            else:
-              libtcod.console_set_char_background(con, x, y, color_dark_ground, libtcod.BKGND_SET)
-        else:
-          # It's visible
-          if wall:
-            libtcod.console_set_char_background(con, x, y, color_light_wall, libtcod.BKGND_SET )
-          else:
-            libtcod.console_set_char_background(con, x, y, color_light_ground, libtcod.BKGND_SET )
-          # Explore the current tile
-          map[map_x][map_y].explored = True
-
-  # Draw all objects in the list
-  for object in objects:
-    if object != player:
-      object.draw()
-    player.draw()
-
-  # Blit the contents of the offscreen "con" buffer to the root console
-  libtcod.console_blit(con, 0, 0, MAP_WIDTH, MAP_HEIGHT, 0, 0, 0)
   # Prepare to render the GUI panel
   libtcod.console_set_default_background(panel, libtcod.black)
   libtcod.console_clear(panel)
@@ -769,12 +1850,54 @@ def render_all():
   libtcod.console_print_ex(panel, 1, 4, libtcod.BKGND_NONE, libtcod.LEFT, 'Archive Depth:: ' + str(archive_depth))
   #display names of objects under the mouse
   libtcod.console_set_default_foreground(panel, libtcod.light_gray)
-  libtcod.console_print_ex(panel, 1, 0, libtcod.BKGND_NONE, libtcod.LEFT, get_names_under_mouse())
+  libtcod.console_print_ex(panel, 1, 0, libtcod.BKGND_NONE, libtcod.LEFT, names)
   # Blit the contents of "panel" to the root console
   libtcod.console_blit(panel, 0, 0, SCREEN_WIDTH, PANEL_HEIGHT, 0, 0, PANEL_Y)
 
 ##########################################################################################################################
 
+def invalidate_panel():
+  #force the GUI panel to be redrawn next frame (e.g. after something else was drawn over it on the root console)
+  global panel_state
+  panel_state = None
+
+##########################################################################################################################
+
+def render_tiles():
+  #work out the background colour of every cell in the camera view according to the FOV,
+  #building the whole colour field as arrays rather than tile by tile
+  (x0, y0) = (camera_x, camera_y)
+  (x1, y1) = (x0 + CAMERA_WIDTH, y0 + CAMERA_HEIGHT)
+  visible = fov_visible(x0, y0, x1, y1)
+  terrain = map.terrain[x0:x1, y0:y1]
+  #explore the tiles that have just come into view
+  explored = map.explored[x0:x1, y0:y1] | visible
+  map.explored[x0:x1, y0:y1] = explored
+
+  #look every (terrain, state) pair up in the palette in one go
+  state = np.where(visible, 2, explored.astype(int))
+  return TERRAIN_PALETTE[terrain, state]
+
+##########################################################################################################################
+
+def render_objects():
+  #gather every object in the camera view and the player's FOV into glyph and colour arrays and
+  #draw them in one batch, in list order with the player last so that it is always on top
+  drawn = [obj for obj in objects if obj is not player] + [player]
+  xs = np.array([obj.x for obj in drawn]) - camera_x
+  ys = np.array([obj.y for obj in drawn]) - camera_y
+  shown = (xs >= 0) & (ys >= 0) & (xs < CAMERA_WIDTH) & (ys < CAMERA_HEIGHT)
+  fov = fov_visible(camera_x, camera_y, camera_x + CAMERA_WIDTH, camera_y + CAMERA_HEIGHT)
+  shown[shown] &= fov[xs[shown], ys[shown]]
+  if not shown.any():
+    return
+  drawn = [obj for (obj, show) in zip(drawn, shown) if show]
+  glyphs = np.array([ord(obj.char) for obj in drawn])
+  colours = np.array([tuple(obj.colour) for obj in drawn])
+  map_renderer.put_chars(xs[shown], ys[shown], glyphs, colours)
+
+##########################################################################################################################
+
 def player_move_or_attack(dx, dy):
   global fov_recompute
   # The coordinates the player is moving to/attacking
@@ -783,8 +1906,8 @@ def player_move_or_attack(dx, dy):
 
   # Try to find an attackable object there
   target = None
-  for object in objects:
-    if object.fighter and object.x == x and object.y == y:
+  for object in object_index.at(x, y):
+    if object.fighter:
       target = object
       break
 
@@ -798,8 +1921,14 @@ def player_move_or_attack(dx, dy):
 ##########################################################################################################################
 
 def save_game():
+  #a game saved over no longer needs its level files
+  saved_seed = saved_game_seed()
+  if saved_seed is not None and saved_seed != game_seed:
+    remove_level_files(saved_seed)
   # Open a new empty shelve (possibly overwriting an old one) to write the game data
-  file = shelve.open('game_data/savegame', 'n')
+  # (the binary pickle protocol stores the map's arrays as raw bytes)
+  file = shelve.open('game_data/savegame', 'n', protocol=2)
+  #(a chunked map flushes its tiles to its own file and only pickles where to find them)
   file['map'] = map
   file['objects'] = objects
   file['player_index'] = objects.index(player)  #index of player in objects list
@@ -808,13 +1937,38 @@ def save_game():
   file['game_state'] = game_state
   file['elevator_index'] = objects.index(elevator)
   file['archive_depth'] = archive_depth
+  file['game_seed'] = game_seed
+  #(every level in the cache goes in the save, including those spilled to disk)
+  file['level_cache'] = level_cache
   file.close()
 
 ##########################################################################################################################
 
+def saved_game_seed():
+  #the seed of the saved game, or None if there is no save
+  try:
+    file = shelve.open('game_data/savegame', 'r')
+  except Exception:
+    return None
+  try:
+    return file.get('game_seed')
+  finally:
+    file.close()
+
+##########################################################################################################################
+
+def remove_level_files(seed):
+  #delete the level store and snapshot files of the game with the given seed
+  for path in glob.glob(LEVEL_FILES % seed):
+    os.remove(path)
+
+##########################################################################################################################
+
 def load_game():
   #open the previously saved shelve and load the game data
-  global map, objects, player, inventory, game_msgs, game_state, archive_depth, elevator
+  global map, objects, player, inventory, game_msgs, game_state, archive_depth, elevator, object_index, level_cache
+  global game_seed
+  stop_pregeneration()
   file = shelve.open('game_data/savegame', 'r')
   map = file['map']
   objects = file['objects']
@@ -824,9 +1978,20 @@ def load_game():
   game_state = file['game_state']
   elevator = objects[file['elevator_index']]
   archive_depth = file['archive_depth']
+  #(older saves have no seed, so the levels below continue from a new one)
+  game_seed = file['game_seed'] if 'game_seed' in file else libtcod.random_get_int(0, 0, 0x7fffffff)
+  #(saves from before the level cache have no visited levels)
+  level_cache = file['level_cache'] if 'level_cache' in file else LevelCache(game_seed)
   file.close()
+  #saves from before maps were stored as arrays
+  if isinstance(map, list):
+    map = TileMap.from_tiles(map)
+  object_index = SpatialIndex(map, objects)
+  #(the streams pick up from the start of the level rather than where they were when the game was saved)
+  seed_streams(level_seed(archive_depth))
 
   initialise_FOV()
+  pregenerate_levels()
 
 ##########################################################################################################################
 
@@ -853,25 +2018,25 @@ def render_bar(x, y, total_width, name, value, maximum, bar_color, back_color):
 def message(new_msg, color = libtcod.white):
   #split the message if necessary, among multiple lines
   new_msg_lines = textwrap.wrap(new_msg, MSG_WIDTH)
+  global game_msgs_version
   for line in new_msg_lines:
     #if the buffer is full, remove the first line to make room for the new one
     if len(game_msgs) == MSG_HEIGHT:
       del game_msgs[0]
       #add the new line as a tuple, with the text and the color
     game_msgs.append( (line, color) )
+  game_msgs_version += 1
 
 ##########################################################################################################################
 
 def menu(header, options, width):
   if len(options) > 26: raise ValueError('Cannot have a menu with more than 26 options .')
   #calculate total height for the header (after auto-wrap) and one line per option
-  header_height = libtcod.console_get_height_rect(con, 0, 0, width, SCREEN_HEIGHT, header)
-  if header == '':
-    header_height = 0
+  header_height = header_layout(header, width)
   height = len(options) + header_height
 
-  #create an off-screen console that represents the menu's window
-  window = libtcod.console_new(width, height)
+  #get an off-screen console that represents the menu's window (reusing one of the same size if we can)
+  window = menu_windows.acquire(width, height)
 
   #print the header, with auto-wrap
   libtcod.console_set_default_foreground(window, libtcod.white)
@@ -890,6 +2055,9 @@ def menu(header, options, width):
   x = SCREEN_WIDTH/2 - width/2
   y = SCREEN_HEIGHT/2 - height/2
   libtcod.console_blit(window, 0, 0, width, height, 0, x, y, 1.0, 0.7)
+  menu_windows.release(window)
+  #the window may cover the GUI panel
+  invalidate_panel()
 
   #present the root console to the player and wait for a key-press
   libtcod.console_flush()
@@ -903,6 +2071,22 @@ def menu(header, options, width):
 
 ##########################################################################################################################
 
+def header_layout(header, width):
+  #the number of lines a menu header takes once wrapped to the given width, remembering the last
+  #HEADER_CACHE_SIZE answers since the same few headers are shown over and over
+  if header == '':
+    return 0
+  if (header, width) in header_heights:
+    header_height = header_heights.pop((header, width))
+  else:
+    header_height = libtcod.console_get_height_rect(0, 0, 0, width, SCREEN_HEIGHT, header)
+    if len(header_heights) >= HEADER_CACHE_SIZE:
+      header_heights.popitem(last=False)  #forget the least recently used header
+  header_heights[(header, width)] = header_height
+  return header_height
+
+##########################################################################################################################
+
 def inventory_menu(header):
   #show a menu with each item of the inventory as an option
   if len(inventory) == 0:
@@ -923,9 +2107,9 @@ def inventory_menu(header):
 
 ##########################################################################################################################
 
-def random_choice_index(chances):  #choose one option from list of chances, returning its index
+def random_choice_index(chances, rng=0):  #choose one option from list of chances, returning its index
   #the dice will land on some number between 1 and the sum of the chances
-  dice = libtcod.random_get_int(0, 1, sum(chances))
+  dice = libtcod.random_get_int(rng, 1, sum(chances))
   #go through all chances, keeping the sum so far
   running_sum = 0
   choice = 0
@@ -938,11 +2122,11 @@ def random_choice_index(chances):  #choose one option from list of chances, retu
 
 ##########################################################################################################################
 
-def random_choice(chances_dict):
+def random_choice(chances_dict, rng=0):
   #choose one option from dictionary of chances, returning its key
   chances = chances_dict.values()
   strings = chances_dict.keys()
-  return strings[random_choice_index(chances)]
+  return strings[random_choice_index(chances, rng)]
 
 ##########################################################################################################################
 ##########################################################################################################################
@@ -964,49 +2148,66 @@ def from_archive_depth(table):
 
 ##########################################################################################################################
 
-def make_map():
-  global map, player, objects, elevator
+def make_map(worldgen=0, spawning=0):
+  #(worldgen and spawning are the random streams to lay the level out and to fill it from)
+  global map, player, objects, elevator, object_index
   objects = [player]
 
+  if MAP_WIDTH * MAP_HEIGHT > MAX_DENSE_MAP_CELLS:
+    make_chunked_map(worldgen)
+    return
+
   #Fill the map with blocked tiles
-  map = [[Tile(True) for y in range(MAP_HEIGHT)] for x in range(MAP_WIDTH)]
+  map = TileMap(MAP_WIDTH, MAP_HEIGHT, TERRAIN_WALL)
+  object_index = SpatialIndex(map)
   # Now to populate the map by 'carving out' rooms and tunnels
+  rooms = carve_rooms(0, 0, MAP_WIDTH, MAP_HEIGHT, MAX_ROOMS, worldgen, spawning)
+  # The first room is where the player starts
+  (player.x, player.y) = rooms[0].center()
+  object_index.add(player)
+  #create an elevator at the center of the last room
+  (x, y) = rooms[-1].center()
+  elevator = Object(x, y, '<', 'Elevator', libtcod.white, always_visible=True)
+  objects.append(elevator)
+  object_index.add(elevator)
+  elevator.send_to_back()  #so it's drawn below the enemies
+
+##########################################################################################################################
+
+def carve_rooms(x0, y0, width, height, max_rooms, worldgen=0, spawning=0):
+  #carve (and populate) up to max_rooms non-overlapping rooms inside an area of the map, each joined to the last
+  #by a tunnel, and return them. The rooms are rolled from the worldgen stream and what is in them from spawning
   rooms = []
   num_rooms = 0
+  #the corners of the rooms so far, so that a new room can be checked against all of them in one go
+  bounds = np.empty((max_rooms, 4), dtype=int)
 
-  for r in range(MAX_ROOMS):
+  for r in range(max_rooms):
     # Select a random width and height for each room between the specified max/min
-    # NOTE:: the '0' argument below determines the 'stream' to select the random number from
+    # NOTE:: the first argument determines the 'stream' to select the random number from (0 is the default one)
     # Look at the documentation for more details
-    w = libtcod.random_get_int(0, ROOM_MIN_SIZE, ROOM_MAX_SIZE)
-    h = libtcod.random_get_int(0, ROOM_MIN_SIZE, ROOM_MAX_SIZE)
-    # Place the new room in a random position without going out of the boundaries of the map
-    x = libtcod.random_get_int(0, 0, MAP_WIDTH - w - 1)
-    y = libtcod.random_get_int(0, 0, MAP_HEIGHT - h - 1)
+    w = libtcod.random_get_int(worldgen, ROOM_MIN_SIZE, ROOM_MAX_SIZE)
+    h = libtcod.random_get_int(worldgen, ROOM_MIN_SIZE, ROOM_MAX_SIZE)
+    if w + 1 > width or h + 1 > height:
+      continue  #the area is too small for this room
+    # Place the new room in a random position without going out of the boundaries of the area
+    x = libtcod.random_get_int(worldgen, x0, x0 + width - w - 1)
+    y = libtcod.random_get_int(worldgen, y0, y0 + height - h - 1)
     new_room = Rect(x, y, w, h)
-    # Run through the other rooms and see if they intersect with this one
-    failed = False
-    for other_room in rooms:
-      if new_room.intersect(other_room):
-        failed = True
-        break
-    if not failed:
+    # Check whether any of the other rooms intersect with this one
+    if not new_room.intersect_any(bounds[:num_rooms]):
       # This means there are no intersections, so this room is valid and can be 'carved out'
       create_room(new_room)
       # Populate the room
-      place_objects(new_room)
+      place_objects(new_room, spawning)
       # Find the center coordinates of new room (will be useful later)
       (new_x, new_y) = new_room.center()
-      # This is the first room, where the player starts at
-      if num_rooms == 0:
-        player.x = new_x
-        player.y = new_y
-      else:
+      if num_rooms > 0:
         # For all rooms after the first: connect it to the previous room with a tunnel
         # Take center coordinates of previous room
         (prev_x, prev_y) = rooms[num_rooms-1].center()
         # Toss a coin (random number that is either 0 or 1)
-        if libtcod.random_get_int(0, 0, 1) == 1:
+        if libtcod.random_get_int(worldgen, 0, 1) == 1:
           # First move horizontally, then vertically
           create_h_tunnel(prev_x, new_x, prev_y)
           create_v_tunnel(prev_y, new_y, new_x)
@@ -1016,56 +2217,209 @@ def make_map():
           create_h_tunnel(prev_x, new_x, new_y)
         # Append the new room to the list
       rooms.append(new_room)
+      bounds[num_rooms] = (new_room.x1, new_room.y1, new_room.x2, new_room.y2)
       num_rooms += 1
-  #create an elevator at the center of the last room
-  elevator = Object(new_x, new_y, '<', 'Elevator', libtcod.white, always_visible=True)
+  return rooms
+
+##########################################################################################################################
+
+def make_chunked_map(worldgen=0):
+  #set up a level too big to generate in one go: only the chunk the player starts in and the one holding the
+  #elevator are generated now, the rest as they come into view (see generate_chunk)
+  global map, elevator, object_index
+  map = ChunkedTileMap(MAP_WIDTH, MAP_HEIGHT, libtcod.random_get_int(worldgen, 0, 0x7fffffff),
+                       LEVEL_STORE_PATH % (game_seed, archive_depth))
+  object_index = SpatialIndex(map)
+  (player.x, player.y) = map.room_centres(0, 0)[0]
+  object_index.add(player)
+  #the elevator goes in the last room of a random chunk
+  chunk_x = libtcod.random_get_int(worldgen, 0, map.chunks_wide - 1)
+  chunk_y = libtcod.random_get_int(worldgen, 0, map.chunks_high - 1)
+  (x, y) = map.room_centres(chunk_x, chunk_y)[-1]
+  elevator = Object(x, y, '<', 'Elevator', libtcod.white, always_visible=True)
   objects.append(elevator)
+  object_index.add(elevator)
   elevator.send_to_back()  #so it's drawn below the enemies
 
 ##########################################################################################################################
 
+def generate_chunk(chunk_map, chunk_x, chunk_y):
+  #carve and populate one chunk of a ChunkedTileMap, returning the centres of the rooms carved into it.
+  #everything comes from random streams seeded by the level and the chunk's position, so a chunk always turns
+  #out the same however late (or in whatever order) it is generated
+  (x0, y0, width, height) = chunk_map.chunk_bounds(chunk_x, chunk_y)
+  chunk_streams = new_streams(chunk_map.chunk_seed(chunk_x, chunk_y))
+  rooms = carve_rooms(x0, y0, width, height, MAX_ROOMS_PER_CHUNK, chunk_streams['worldgen'], chunk_streams['spawning'])
+  centres = [room.center() for room in rooms]
+  delete_streams(chunk_streams)
+  if not centres:
+    centres = [(x0 + width // 2, y0 + height // 2)]
+  #tunnel from the first room to a point on each edge shared with another chunk; the chunk on the other side
+  #tunnels to the neighbouring point on its own edge, which joins the two up
+  (hub_x, hub_y) = centres[0]
+  for (edge_x, edge_y) in chunk_map.chunk_exits(chunk_x, chunk_y):
+    create_h_tunnel(hub_x, edge_x, hub_y)
+    create_v_tunnel(hub_y, edge_y, edge_x)
+  return centres
+
+##########################################################################################################################
+
 def next_level():
-  global archive_depth, ini
   #advance to the next level
   message('You take a moment to rest and recover your strength while you wait for the elevator.', libtcod.light_violet)
   player.fighter.heal(NEW_FLOOR_HEAL)  #heal the player by NEW_FLOOR_HEAL
 
   message('As the elevator shudders to a halt you hear the rope snap and you step out, ready to proceed deeper into the heart of the Archive...', libtcod.light_violet)
-  archive_depth += 1
-  make_map()  #create a fresh new level!
+  change_level(archive_depth + 1)
+
+##########################################################################################################################
+
+def change_level(depth):
+  #leave the current level for the one at another depth, restoring that from the level cache if the player has
+  #been there before and creating a fresh new level if not. The level being left goes into the cache
+  global archive_depth
+  level_cache.put(archive_depth, snapshot_level())
+  if isinstance(map, ChunkedTileMap):
+    map.close()  #its tiles stay in the store's file for when the level is restored
+  archive_depth = depth
+  if depth in level_cache or depth in pregenerated:
+    if depth in level_cache:
+      level = level_cache.take(depth)
+    else:
+      #(this only waits if the player got here before the worker finished)
+      level = pickle.loads(pregenerated.pop(depth).get())
+    restore_level(level)
+    #(build_level leaves the worldgen and spawning streams part way through, but the streams used in play
+    #start from the same place either way)
+    seed_streams(level_seed(depth))
+  else:
+    build_level(depth)
   initialise_FOV()
+  pregenerate_levels()
+
+##########################################################################################################################
+
+def level_seed(depth):
+  #the seed for the level at a depth in this game
+  return (game_seed * 2654435761 + depth * 40503) & 0x7fffffff
+
+##########################################################################################################################
+
+def build_level(depth):
+  #make the level at a depth the current one, generating it from its own seed so that it comes out the same
+  #whether it is built here or by pregenerate_level
+  global object_index
+  seed_streams(level_seed(depth))
+  make_map(streams['worldgen'], streams['spawning'])
+  #refile everything in objects order, as restore_level does: the order objects are filed in decides the order
+  #they are found in, and so what happens, so it has to be the same whichever way the level was made
+  object_index = SpatialIndex(map, objects)
+
+##########################################################################################################################
+
+def stream_seed(seed, name):
+  #the seed for a named stream, so that streams seeded from the same seed do not all roll the same numbers
+  return (seed * 1000003 ^ zlib.crc32(name.encode('ascii'))) & 0x7fffffff
+
+##########################################################################################################################
+
+def new_streams(seed):
+  #a libtcod random stream for each of RNG_STREAMS, all seeded from seed
+  return dict((name, libtcod.random_new_from_seed(stream_seed(seed, name))) for name in RNG_STREAMS)
+
+##########################################################################################################################
+
+def delete_streams(named_streams):
+  for stream in named_streams.values():
+    libtcod.random_delete(stream)
+
+##########################################################################################################################
+
+def seed_streams(seed):
+  #replace the game's random streams with a new set seeded from seed
+  global streams
+  delete_streams(streams)
+  streams = new_streams(seed)
+
+##########################################################################################################################
+
+def pregenerate_level(seed, depth):
+  #(runs in a worker process) build the level at a depth of the game with the given seed and return it
+  #pickled, ready for restore_level. The player is a stand in: only where they start matters
+  global game_seed, archive_depth, player
+  (game_seed, archive_depth) = (seed, depth)
+  player = Object(0, 0, '@', 'player', libtcod.light_cyan, blocks=True)
+  build_level(depth)
+  return pickle.dumps(snapshot_level(), 2)
+
+##########################################################################################################################
+
+def pregenerate_levels():
+  #start generating the next PREGENERATE_LEVELS floors in the background, if they are not already on the way
+  global pregeneration_pool
+  if PREGENERATE_LEVELS <= 0:
+    return
+  if pregeneration_pool is None:
+    pregeneration_pool = multiprocessing.Pool(min(PREGENERATE_LEVELS, multiprocessing.cpu_count()))
+  for depth in range(archive_depth + 1, archive_depth + 1 + PREGENERATE_LEVELS):
+    if depth not in level_cache and depth not in pregenerated:
+      pregenerated[depth] = pregeneration_pool.apply_async(pregenerate_level, (game_seed, depth))
+
+##########################################################################################################################
+
+def stop_pregeneration():
+  #throw away any levels generated ahead (e.g. for a game that is over) and shut the workers down
+  global pregeneration_pool
+  pregenerated.clear()
+  if pregeneration_pool is not None:
+    pregeneration_pool.terminate()
+    pregeneration_pool.join()
+    pregeneration_pool = None
+
+##########################################################################################################################
+
+def snapshot_level():
+  #everything about the current level that has to be kept to come back to it (the player goes with the player)
+  others = [obj for obj in objects if obj is not player]
+  return {'map': map, 'objects': others, 'player_index': objects.index(player), 'player_pos': (player.x, player.y),
+          'elevator_index': others.index(elevator)}
+
+##########################################################################################################################
+
+def restore_level(level):
+  #make a level from snapshot_level the current one, with the player back where they left it
+  global map, objects, elevator, object_index
+  map = level['map']
+  objects = level['objects']
+  elevator = objects[level['elevator_index']]
+  (player.x, player.y) = level['player_pos']
+  objects.insert(level['player_index'], player)
+  object_index = SpatialIndex(map, objects)
 
 ##########################################################################################################################
 
 def create_room(room):
   global map
-  #Work through the tiles in a rectangle and make them passable
-  for x in range(room.x1 + 1, room.x2):
-    for y in range(room.y1 +1, room.y2):
-      map[x][y].blocked = False
-      map[x][y].block_sight = False
+  #Make the tiles inside the rectangle passable, all in one slice
+  map.set_terrain(slice(room.x1 + 1, room.x2), slice(room.y1 + 1, room.y2), TERRAIN_FLOOR)
 
 ##########################################################################################################################
 
 def create_h_tunnel(x1, x2, y):
   # This will 'carve out' a horizontal tunnel between (x1,y) and (x2,y)
   global map
-  for x in range(min(x1, x2), max(x1, x2) + 1):
-    map[x][y].blocked = False
-    map[x][y].block_sight = False
+  map.set_terrain(slice(min(x1, x2), max(x1, x2) + 1), y, TERRAIN_FLOOR)
 
 ##########################################################################################################################
 
 def create_v_tunnel(y1, y2, x):
     global map
-    # This will 'carve out' a horizontal tunnel between (x,y1) and (x,y2)
-    for y in range(min(y1, y2), max(y1, y2) + 1):
-        map[x][y].blocked = False
-        map[x][y].block_sight = False
+    # This will 'carve out' a vertical tunnel between (x,y1) and (x,y2)
+    map.set_terrain(x, slice(min(y1, y2), max(y1, y2) + 1), TERRAIN_FLOOR)
 
 ##########################################################################################################################
 
-def place_objects(room):
+def place_objects(room, rng=0):
   #NOTE:: from_archive_depth([[value,depth_1], [value,depth_2]])
   max_enemies = from_archive_depth([[2, 1], [3, 4], [5, 6], [6, 9], [8, 10]])
   max_items = from_archive_depth([[1, 1], [2, 4], [3, 7]])
@@ -1085,17 +2439,17 @@ def place_objects(room):
   item_chances['shield'] = from_archive_depth([[10, 6]])
 
   # Choose random number of enemies
-  num_enemies = libtcod.random_get_int(0, 0, max_enemies)
+  num_enemies = libtcod.random_get_int(rng, 0, max_enemies)
   for i in range(num_enemies):
     # Choose random spot for the enemy
-    x = libtcod.random_get_int(0, room.x1+1, room.x2-1)
-    y = libtcod.random_get_int(0, room.y1+1, room.y2-1)
+    x = libtcod.random_get_int(rng, room.x1+1, room.x2-1)
+    y = libtcod.random_get_int(rng, room.y1+1, room.y2-1)
     #only place it if the tile is not blocked
     if not is_blocked(x, y):
       # % chances: 20% VI, 40% security guard, 1% agent, 39% guard dog
-      choice = random_choice(enemy_chances)
+      choice = random_choice(enemy_chances, rng)
       if choice == 'dog':
-        fighter_component = Fighter(hp=15, defense=0, power=4, xp=25, death_function=enemy_death)
+        fighter_component = Fighter(hp=15, defense=0, power=4, xp=25, speed=150, death_function=enemy_death)
         ai_component = BasicEnemy()
         enemy = Object(x, y, 'd', 'dog', libtcod.desaturated_sea, blocks=True, fighter=fighter_component, ai=ai_component)
       elif choice == 'thief':
@@ -1103,24 +2457,25 @@ def place_objects(room):
         ai_component = BasicEnemy()
         enemy = Object(x, y, 'h', 'thief', libtcod.light_grey, blocks=True, fighter=fighter_component, ai=ai_component)
       elif choice == 'Curator':
-        fighter_component = Fighter(hp=40, defense=3, power=8, xp=70, death_function=enemy_death)
-        ai_component = BasicEnemy()
+        fighter_component = Fighter(hp=40, defense=3, power=8, xp=70, speed=75, death_function=enemy_death)
+        ai_component = HunterEnemy()
         enemy = Object(x, y, 'C', 'Curator', libtcod.crimson, blocks=True, fighter=fighter_component, ai=ai_component)
       elif choice == 'rat':
-        fighter_component = Fighter(hp=5, defense=0, power=3, xp=10, death_function=enemy_death)
+        fighter_component = Fighter(hp=5, defense=0, power=3, xp=10, speed=120, death_function=enemy_death)
         ai_component = BasicEnemy()
         enemy = Object(x, y, 'r', 'rat', libtcod.light_grey, blocks=True, fighter=fighter_component, ai=ai_component)
       objects.append(enemy)
+      object_index.add(enemy)
 
   #choose random number of items
-  num_items = libtcod.random_get_int(0, 0, max_items)
+  num_items = libtcod.random_get_int(rng, 0, max_items)
   for i in range(num_items):
     #choose random spot for this item
-    x = libtcod.random_get_int(0, room.x1+1, room.x2-1)
-    y = libtcod.random_get_int(0, room.y1+1, room.y2-1)
+    x = libtcod.random_get_int(rng, room.x1+1, room.x2-1)
+    y = libtcod.random_get_int(rng, room.y1+1, room.y2-1)
     #only place it if the tile is not blocked
     if not is_blocked(x, y):
-      choice = random_choice(item_chances)
+      choice = random_choice(item_chances, rng)
       if choice == "heal":
         item_component = Item(use_function=heal, function_var=heal_small)
         item = Object(x, y, '!', 'strange bottle', libtcod.chartreuse, item=item_component)
@@ -1143,19 +2498,14 @@ def place_objects(room):
 
 
       objects.append(item)
+      object_index.add(item)
       item.send_to_back()  #items appear below other objects
 
 ##########################################################################################################################
 
 def is_blocked(x, y):
-  # First test to see if the map tile is blocked
-  if map[x][y].blocked:
-    return True
-  # Now check for any blocking objects on that tile
-  for object in objects:
-    if object.blocks and object.x == x and object.y == y:
-      return True
-  return False
+  # A tile is blocked if its terrain is, or a blocking object is standing on it (the map keeps the two combined)
+  return bool(map.impassable[x, y])
 
 ##########################################################################################################################
 ##########################################################################################################################
@@ -1167,8 +2517,8 @@ def is_blocked(x, y):
 ###############################
 '''
 
-def check_level_up():
-  #see if the player's experience is enough to level-up
+def check_level_up(choose=None):
+  #see if the player's experience is enough to level-up (choose picks the stat to raise instead of asking)
   level_up_xp = LEVEL_UP_BASE + player.level * LEVEL_UP_FACTOR
   if player.fighter.xp >= level_up_xp:
     player.level += 1
@@ -1178,10 +2528,13 @@ def check_level_up():
     player.fighter.xp -= level_up_xp
     choice = None
     while choice == None:  #keep asking until a choice is made
-      choice = menu('Level up! Choose a stat to raise:\n',
-      ['Constitution (+10 HP, from ' + str(player.fighter.max_hp) + '\nand restored to full hp)',
-      'Strength (+1 attack, from ' + str(player.fighter.power) + ')',
-      'Agility (+1 defense, from ' + str(player.fighter.defense) + ')'], LEVEL_SCREEN_WIDTH)
+      if choose is not None:
+        choice = choose()
+      else:
+        choice = menu('Level up! Choose a stat to raise:\n',
+        ['Constitution (+10 HP, from ' + str(player.fighter.max_hp) + '\nand restored to full hp)',
+        'Strength (+1 attack, from ' + str(player.fighter.power) + ')',
+        'Agility (+1 defense, from ' + str(player.fighter.defense) + ')'], LEVEL_SCREEN_WIDTH)
       if choice == 0:
         player.fighter.base_max_hp += 10
         player.fighter.hp += 10
@@ -1232,10 +2585,12 @@ def main_menu():
       #(special case) Alt+Enter: toggle fullscreen
       libtcod.console_set_fullscreen(not libtcod.console_is_fullscreen())
 
+  menu_windows.clear()
+
 ##########################################################################################################################
 
-def new_game():
-  global player, inventory, game_msgs, game_state, archive_depth
+def new_game(seed=None):
+  global player, inventory, game_msgs, game_state, archive_depth, game_seed, level_cache
 
   # Initialise the player character
   fighter_component = Fighter(hp=100, defense=1, power=2, sp=20, xp= 0, death_function=player_death)
@@ -1251,10 +2606,18 @@ def new_game():
   obj.always_visible = True
 
   game_msgs = []
-  # Generate the dungeon
+  # Generate the dungeon (from the given seed, or a random one)
+  stop_pregeneration()
+  #the last game's levels are only kept if that is the game in the save
+  if game_seed != saved_game_seed():
+    level_cache.clear()
+    remove_level_files(game_seed)  #(its current level and any generated ahead too)
+  game_seed = libtcod.random_get_int(0, 0, 0x7fffffff) if seed is None else seed
   archive_depth = 1
-  make_map()
+  level_cache = LevelCache(game_seed)
+  build_level(archive_depth)
   initialise_FOV()
+  pregenerate_levels()
   # Now we are up and running!
   game_state = 'playing'
     # Welcome message
@@ -1263,16 +2626,102 @@ def new_game():
 ##########################################################################################################################
 
 def initialise_FOV():
-  global fov_map, fov_recompute
+  global fov_map, fov_recompute, path_map, hunt_path
   fov_recompute = True
   libtcod.console_clear(con)  #unexplored areas start black (which is the default background color)
-  # Generate the FOV map
-  fov_map = libtcod.map_new(MAP_WIDTH, MAP_HEIGHT)
-  for y in range(MAP_HEIGHT):
-    for x in range(MAP_WIDTH):
-      libtcod.map_set_properties(fov_map, x, y, not map[x][y].block_sight, not map[x][y].blocked)
+  map_renderer.invalidate()
+  # The FOV map covers the whole level if it fits in a window, otherwise the window around the player
+  (width, height) = (min(map.width, FOV_WINDOW_WIDTH), min(map.height, FOV_WINDOW_HEIGHT))
+  # Reuse the native FOV map from the last level if it is the right size, rather than leaking a new one every level
+  if fov_map is not None and (libtcod.map_get_width(fov_map), libtcod.map_get_height(fov_map)) != (width, height):
+    libtcod.map_delete(fov_map)
+    libtcod.path_delete(hunt_path)
+    libtcod.map_delete(path_map)
+    fov_map = None
+  if fov_map is None:
+    fov_map = libtcod.map_new(width, height)
+    path_map = libtcod.map_new(width, height)
+    hunt_path = libtcod.path_new_using_map(path_map)
+  load_fov_window()
+  #none of the paths worked out on the last level mean anything here, and everything on the new one starts
+  #asleep until the player comes near
+  path_cache.new_generation()
+  scheduler.reset()
+  noise_map.clear()
 
-  libtcod.console_clear(con)  #unexplored areas start black (which is the default background color)
+##########################################################################################################################
+
+def find_path(x0, y0, x1, y1):
+  #the tiles (as map positions, not including the start) along the shortest path from (x0, y0) to (x1, y1) that
+  #goes around walls and anything blocking, or None if there is none inside the FOV window
+  (ox, oy) = fov_origin
+  if not (fov_window_covers(x0, y0, x0 + 1, y0 + 1) and fov_window_covers(x1, y1, x1 + 1, y1 + 1)):
+    return None
+  (width, height) = (libtcod.map_get_width(path_map), libtcod.map_get_height(path_map))
+  (wx, wy) = (slice(ox, ox + width), slice(oy, oy + height))
+  libtcod.map_set_cells(path_map, ~map.block_sight[wx, wy].T, ~map.impassable[wx, wy].T)
+  #whatever is at the destination (the player) is in the way, but it is where the path has to end
+  libtcod.map_set_properties(path_map, x1 - ox, y1 - oy, True, True)
+  if not libtcod.path_compute(hunt_path, x0 - ox, y0 - oy, x1 - ox, y1 - oy):
+    return None
+  return [(x + ox, y + oy) for (x, y) in (libtcod.path_get(hunt_path, i) for i in range(libtcod.path_size(hunt_path)))]
+
+##########################################################################################################################
+
+def load_fov_window():
+  #centre the FOV window on the player (as far as the edges of the map allow) and load that part of the map
+  #into the FOV map in one go (libtcod keeps its cells row by row, hence the transposes)
+  global fov_origin, fov_recompute
+  (width, height) = (libtcod.map_get_width(fov_map), libtcod.map_get_height(fov_map))
+  x0 = min(max(player.x - width // 2, 0), map.width - width)
+  y0 = min(max(player.y - height // 2, 0), map.height - height)
+  fov_origin = (x0, y0)
+  (x1, y1) = (x0 + width, y0 + height)
+  libtcod.map_set_cells(fov_map, ~map.block_sight[x0:x1, y0:y1].T, ~map.blocked[x0:x1, y0:y1].T)
+  fov_recompute = True
+
+##########################################################################################################################
+
+def fov_window_covers(x0, y0, x1, y1):
+  #whether the area of the map from (x0, y0) up to (x1, y1) is all inside the FOV window
+  (ox, oy) = fov_origin
+  return (x0 >= ox and y0 >= oy and
+          x1 <= ox + libtcod.map_get_width(fov_map) and y1 <= oy + libtcod.map_get_height(fov_map))
+
+##########################################################################################################################
+
+def in_fov(x, y):
+  #whether a map position is in the player's FOV (anything outside the FOV window is not)
+  (x, y) = (x - fov_origin[0], y - fov_origin[1])
+  if x < 0 or y < 0 or x >= libtcod.map_get_width(fov_map) or y >= libtcod.map_get_height(fov_map):
+    return False
+  return libtcod.map_is_in_fov(fov_map, x, y)
+
+##########################################################################################################################
+
+def fov_visible(x0, y0, x1, y1):
+  #which cells of the area of the map from (x0, y0) up to (x1, y1) are in the player's FOV, as a bool array
+  visible = np.zeros((x1 - x0, y1 - y0), dtype=bool)
+  (ox, oy) = fov_origin
+  cells = libtcod.map_get_cells(fov_map).T
+  (wx0, wy0) = (max(x0, ox), max(y0, oy))
+  (wx1, wy1) = (min(x1, ox + cells.shape[0]), min(y1, oy + cells.shape[1]))
+  if wx0 < wx1 and wy0 < wy1:
+    visible[wx0 - x0:wx1 - x0, wy0 - y0:wy1 - y0] = (cells[wx0 - ox:wx1 - ox, wy0 - oy:wy1 - oy] & libtcod.MAP_CELL_FOV) != 0
+  return visible
+
+##########################################################################################################################
+
+def change_terrain(x, y, terrain):
+  #change a single tile of the current level during play (a door opening, a wall being blown out...)
+  #and update the FOV map to match
+  global fov_recompute
+  map.set_terrain(x, y, terrain)
+  flow_field.invalidate()
+  path_cache.cell_changed(x, y)
+  if fov_window_covers(x, y, x + 1, y + 1):
+    libtcod.map_set_properties(fov_map, x - fov_origin[0], y - fov_origin[1], not map.block_sight[x, y], not map.blocked[x, y])
+  fov_recompute = True
 
 ##########################################################################################################################
 
@@ -1285,42 +2734,136 @@ def play_game():
   key = libtcod.Key()
 
   (camera_x, camera_y) = (0, 0)
+  invalidate_panel()
 
   # The main loop will run as long as the window is open
+  needs_render = True
+  fps = LIMIT_FPS
   while not libtcod.console_is_window_closed():
-    libtcod.sys_check_for_event(libtcod.EVENT_KEY_PRESS|libtcod.EVENT_MOUSE,key,mouse)
-    render_all()
-    libtcod.console_flush()
-    check_level_up()
-    # Erase all objects before they are drawn in again
-    for object in objects:
-      object.clear()
+    frame_timer.next_frame()
+    # Run faster while something on screen is moving, and drop back once it stops
+    active = libtcod.sys_elapsed_milli() < loop_active_until
+    if (ACTIVE_FPS if active else LIMIT_FPS) != fps:
+      fps = ACTIVE_FPS if active else LIMIT_FPS
+      libtcod.sys_set_fps(fps)
+
+    if EVENT_DRIVEN_LOOP and not needs_render and not active:
+      # Nothing will change until there is input, so sleep until it arrives
+      with frame_timer.phase('wait'):
+        event = libtcod.sys_wait_for_event(libtcod.EVENT_KEY_PRESS|libtcod.EVENT_MOUSE,key,mouse,False)
+    else:
+      with frame_timer.phase('events'):
+        event = libtcod.sys_check_for_event(libtcod.EVENT_KEY_PRESS|libtcod.EVENT_MOUSE,key,mouse)
+    if event & libtcod.EVENT_MOUSE_MOVE:
+      # Keep the names under the mouse following it smoothly
+      keep_loop_active(HOVER_ACTIVE_MS)
+
+    # (a key press is drawn once it has been handled, below, rather than before as well)
+    if needs_render or event & libtcod.EVENT_MOUSE or active or not EVENT_DRIVEN_LOOP:
+      with frame_timer.phase('render'):
+        render_all()
+      if frame_timer.show_overlay:
+        frame_timer.draw_overlay(0, SCREEN_WIDTH - 1, 0)
+      with frame_timer.phase('flush'):
+        libtcod.console_flush()
+      needs_render = False
+      check_level_up()
+
     # Check for input
-    player_action = handle_keys()
-    if player_action == 'exit':
-      save_game()
-      break
-    # Let the enemies take their turn
-    if game_state == 'playing' and player_action != 'didnt-take-turn':
-      for object in objects:
-        if object.ai:
-          object.ai.take_turn()
+    if event & libtcod.EVENT_KEY_PRESS or not EVENT_DRIVEN_LOOP:
+      with frame_timer.phase('input'):
+        player_action = handle_keys()
+      if player_action == 'exit':
+        save_game()
+        break
+      # Let the enemies take their turn
+      if game_state == 'playing' and player_action != 'didnt-take-turn':
+        with frame_timer.phase('ai'):
+          take_enemy_turns()
+      needs_render = True
+
+  # Keep the frame timings from this session for later inspection
+  frame_timer.dump(FRAME_TIMES_PATH)
+  stop_pregeneration()
 
 
+##########################################################################################################################
+
+def take_enemy_turns():
+  #everything else's turn, once the player has taken theirs
+  noise_map.propagate(map)
+  scheduler.run_turn(player.x, player.y)
+
+##########################################################################################################################
+
+def simulate_game(controller, seed=None, max_turns=10000):
+  #play a game through without a window: nothing is drawn or flushed, and controller stands in for the keyboard.
+  #Its take_turn() does one thing for the player each turn (through player_move_or_attack, Item.use, next_level
+  #and so on, as handle_keys would) and its level_up() picks the stat to raise (0, 1 or 2, as in check_level_up).
+  #Returns the number of turns played; the game is left as it ended, so game_state, archive_depth and
+  #player.fighter.killed_by say how it went
+  global camera_x, camera_y
+  new_game(seed)
+  (camera_x, camera_y) = (0, 0)
+  turns = 0
+  while game_state == 'playing' and turns < max_turns:
+    update_view()
+    controller.take_turn()
+    if game_state == 'playing':
+      take_enemy_turns()
+    check_level_up(controller.level_up)
+    turns += 1
+  stop_pregeneration()
+  return turns
+
+##########################################################################################################################
+
+def keep_loop_active(ms):
+  #keep the main loop running at ACTIVE_FPS (rather than sleeping until input) for at least another ms milliseconds,
+  #for anything that changes on screen without input such as mouse hover text or animations
+  global loop_active_until
+  loop_active_until = max(loop_active_until, libtcod.sys_elapsed_milli() + ms)
+
 ##########################################################################################################################
 ##########################################################################################################################
 
 # dejavu16x16_gs_tc
 # arial10x10
 
-# Set the font and framerate
-libtcod.console_set_custom_font('dejavu16x16_gs_tc.png', libtcod.FONT_TYPE_GREYSCALE | libtcod.FONT_LAYOUT_TCOD)
-libtcod.sys_set_fps(LIMIT_FPS)
-# Initialise the screen
-libtcod.console_init_root(SCREEN_WIDTH, SCREEN_HEIGHT, '<<::ASFHoTUTW::>> V0.2', False)
-# Initialise an offscreen console to allow buffering/layering and blitting of multiple objects without having to write to the screen
-con = libtcod.console_new(MAP_WIDTH, MAP_HEIGHT)
-# Initialise the HUD
-panel = libtcod.console_new(SCREEN_WIDTH, PANEL_HEIGHT)
-
-main_menu()
+def initialise_console():
+  global con, panel, map_renderer
+  # Set the font and framerate
+  libtcod.console_set_custom_font('dejavu16x16_gs_tc.png', libtcod.FONT_TYPE_GREYSCALE | libtcod.FONT_LAYOUT_TCOD)
+  libtcod.sys_set_fps(LIMIT_FPS)
+  # Initialise the screen
+  libtcod.console_init_root(SCREEN_WIDTH, SCREEN_HEIGHT, '<<::ASFHoTUTW::>> V0.2', False)
+  # Initialise an offscreen console to allow buffering/layering and blitting of multiple objects without having to write to the screen
+  # It only ever holds what the camera can see, however big the map is
+  con = libtcod.console_new(CAMERA_WIDTH, CAMERA_HEIGHT)
+  map_renderer = MapRenderer(con)
+  # Initialise the HUD
+  panel = libtcod.console_new(SCREEN_WIDTH, PANEL_HEIGHT)
+
+# Per-phase timings of the main loop (F3 shows them on screen)
+frame_timer = FrameTimer()
+# Reusable menu windows, and the wrapped height of recently shown menu headers
+menu_windows = WindowPool()
+header_heights = collections.OrderedDict()
+# The levels the player has visited, and the worker processes generating the ones below ahead of time
+# (depth -> pending pickled level from pregenerate_level)
+level_cache = LevelCache()
+pregeneration_pool = None
+pregenerated = {}
+# The way to the player for chasing enemies
+flow_field = FlowField()
+# The way to the player for hunting enemies
+path_cache = PathCache()
+# Who acts when, and what they can hear
+scheduler = Scheduler()
+noise_map = NoiseMap()
+
+##########################################################################################################################
+
+if __name__ == '__main__':
+  initialise_console()
+  main_menu()
@@ -0,0 +1,140 @@
+import os
+os.environ.setdefault('ARCHIVE_HEADLESS', '1')
+import collections
+import multiprocessing
+import sys
+import timeit
+
+import main
+
+'''
+Batch playthroughs without a window, for balancing (the from_archive_depth tables) and for keeping an eye on
+how fast the AI runs.
+
+  python simulate.py [games] [workers] [controller]
+
+Every game is played by main.simulate_game from its own seed (1, 2, 3...), so a run can be repeated exactly,
+with a controller from CONTROLLERS playing the player. The games are shared out over a pool of worker
+processes and the report gives turns per second, how deep the games got and what ended them.
+'''
+
+GAMES = 1000
+MAX_TURNS = 5000
+
+##########################################################################################
+##########################################################################################
+
+
+'''
+#############################
+## <--> Player controllers ##
+#############################
+'''
+
+
+class GreedyController:
+  # Heads straight for the elevator (following a flow field to it, since a bot may as well know where it is),
+  # fighting anything that gets next to it, drinking a healing bottle when low and picking up whatever it
+  # walks over. Always puts level ups into constitution.
+  HEAL_BELOW = 0.35
+
+  def __init__(self):
+    self.route = None
+
+  def take_turn(self):
+    player = main.player
+    #fight back
+    for (dx, dy) in main.FlowField.NEIGHBOURS:
+      for obj in main.object_index.at(player.x + dx, player.y + dy):
+        if obj.fighter and obj.ai:
+          main.player_move_or_attack(dx, dy)
+          return
+    #heal up
+    if player.fighter.hp < player.fighter.max_hp * GreedyController.HEAL_BELOW:
+      for obj in main.inventory:
+        if obj.item.use_function is main.heal:
+          obj.item.use()
+          return
+    #loot
+    if len(main.inventory) < 26:
+      for obj in main.object_index.at(player.x, player.y):
+        if obj.item:
+          obj.item.pick_up()
+          return
+    #go down
+    if (player.x, player.y) == (main.elevator.x, main.elevator.y):
+      main.next_level()
+      return
+    if self.route is None:
+      self.route = main.FlowField(max(main.map.width, main.map.height))
+    self.route.update(main.map, main.elevator.x, main.elevator.y)
+    step = self.route.step_from(player.x, player.y)
+    if step is not None:
+      main.player_move_or_attack(*step)
+    #(otherwise something is in the way, so wait for it to move)
+
+  def level_up(self):
+    return 0
+
+CONTROLLERS = {'greedy': GreedyController}
+
+##########################################################################################
+##########################################################################################
+
+
+'''
+######################
+## <--> Simulations ##
+######################
+'''
+
+
+def init_worker():
+  #the workers cannot start processes of their own, so no levels are generated ahead
+  main.PREGENERATE_LEVELS = 0
+  main.initialise_console()
+
+def play(args):
+  #play one game, returning (seed, turns, seconds, depth reached, cause of death or None if it survived)
+  (seed, controller, max_turns) = args
+  start = timeit.default_timer()
+  turns = main.simulate_game(CONTROLLERS[controller](), seed, max_turns)
+  elapsed = timeit.default_timer() - start
+  cause = None
+  if main.game_state == 'dead':
+    cause = main.player.fighter.killed_by or 'unknown'
+  return (seed, turns, elapsed, main.archive_depth, cause)
+
+def simulate(games=GAMES, workers=None, controller='greedy', max_turns=MAX_TURNS):
+  #play games seeded 1..games over a pool of workers and return the results of each, in seed order
+  pool = multiprocessing.Pool(workers or multiprocessing.cpu_count(), initializer=init_worker)
+  try:
+    jobs = [(seed, controller, max_turns) for seed in range(1, games + 1)]
+    return sorted(pool.imap_unordered(play, jobs, chunksize=max(1, games // 100)))
+  finally:
+    pool.close()
+    pool.join()
+
+def report(results, wall_time):
+  turns = sum(result[1] for result in results)
+  game_time = sum(result[2] for result in results)
+  print('%d games, %d turns in %.1fs: %.0f turns/s overall, %.0f turns/s per worker' %
+        (len(results), turns, wall_time, turns / wall_time, turns / game_time))
+  print('')
+  print('depth reached:')
+  depths = collections.Counter(result[3] for result in results)
+  for depth in sorted(depths):
+    print('  %3d  %6d' % (depth, depths[depth]))
+  print('')
+  print('cause of death:')
+  causes = collections.Counter(result[4] or 'ran out of turns' for result in results)
+  for (cause, count) in causes.most_common():
+    print('  %-24s %6d' % (cause, count))
+
+if __name__ == '__main__':
+  games = int(sys.argv[1]) if len(sys.argv) > 1 else GAMES
+  workers = int(sys.argv[2]) if len(sys.argv) > 2 else None
+  controller = sys.argv[3] if len(sys.argv) > 3 else 'greedy'
+  start = timeit.default_timer()
+  results = simulate(games, workers, controller)
+  report(results, timeit.default_timer() - start)
@@ -0,0 +1,184 @@
+import os
+os.environ.setdefault('ARCHIVE_HEADLESS', '1')
+import unittest
+
+import main
+
+'''
+The parts of the enemies' turns that have to come out the same every time: cached hunting paths, the order
+and rate actors are scheduled at, and how noise spreads.
+
+  python -m unittest discover tests
+'''
+
+def setUpModule():
+  main.initialise_console()
+
+def open_level(width=40, height=24, player_at=(30, 12)):
+  #make a walled room with only the player in it the current level
+  main.map = main.TileMap(width, height, main.TERRAIN_WALL)
+  main.map.set_terrain(slice(1, width - 1), slice(1, height - 1), main.TERRAIN_FLOOR)
+  fighter = main.Fighter(hp=100, defense=1, power=2, xp=0, death_function=main.player_death)
+  main.player = main.Object(player_at[0], player_at[1], '@', 'player', main.libtcod.light_cyan, blocks=True, fighter=fighter)
+  main.objects = [main.player]
+  main.object_index = main.SpatialIndex(main.map, main.objects)
+  main.initialise_FOV()
+
+def add_enemy(x, y, name='enemy', ai=None, speed=main.NORMAL_SPEED):
+  fighter = main.Fighter(hp=10, defense=0, power=1, xp=0, speed=speed, death_function=main.enemy_death)
+  enemy = main.Object(x, y, 'e', name, main.libtcod.red, blocks=True, fighter=fighter, ai=ai)
+  main.objects.append(enemy)
+  main.object_index.add(enemy)
+  return enemy
+
+def registered(cache, obj):
+  #the tiles obj's path is registered on
+  return set(cell for (cell, objs) in cache.through.items() if obj in objs)
+
+
+class PathCacheTest(unittest.TestCase):
+  def setUp(self):
+    open_level()
+    self.cache = main.PathCache()
+    self.hunter = add_enemy(3, 12)
+
+  def test_follows_the_cached_path(self):
+    first = self.cache.next_step(self.hunter, main.player.x, main.player.y)
+    steps = self.cache.paths[self.hunter][2]
+    self.hunter.move(first[0] - self.hunter.x, first[1] - self.hunter.y)
+    second = self.cache.next_step(self.hunter, main.player.x, main.player.y)
+    self.assertTrue(self.cache.paths[self.hunter][2] is steps)
+    self.assertEqual(max(abs(second[0] - first[0]), abs(second[1] - first[1])), 1)
+
+  def test_a_hunter_moved_off_its_path_finds_a_new_one(self):
+    self.cache.next_step(self.hunter, main.player.x, main.player.y)
+    (self.hunter.x, self.hunter.y) = (10, 3)
+    main.object_index.move(self.hunter)
+    step = self.cache.next_step(self.hunter, main.player.x, main.player.y)
+    self.assertEqual(max(abs(step[0] - 10), abs(step[1] - 3)), 1)
+
+  def test_registrations_follow_the_path(self):
+    step = self.cache.next_step(self.hunter, main.player.x, main.player.y)
+    self.assertEqual(registered(self.cache, self.hunter), set(self.cache.paths[self.hunter][2]))
+    self.assertFalse(step in registered(self.cache, self.hunter))
+    self.cache.forget(self.hunter)
+    self.assertEqual(self.cache.through, {})
+
+  def test_terrain_changes_drop_the_paths_through_them(self):
+    self.cache.next_step(self.hunter, main.player.x, main.player.y)
+    bystander = add_enemy(3, 20)
+    self.cache.next_step(bystander, 3, 22)
+    cell = self.cache.paths[self.hunter][2][2]
+    self.cache.cell_changed(*cell)
+    self.assertFalse(self.hunter in self.cache.paths)
+    self.assertTrue(bystander in self.cache.paths)
+    self.assertEqual(registered(self.cache, self.hunter), set())
+
+  def test_moving_the_target_within_tolerance_keeps_the_path(self):
+    step = self.cache.next_step(self.hunter, main.player.x, main.player.y)
+    steps = self.cache.paths[self.hunter][2]
+    self.hunter.move(step[0] - self.hunter.x, step[1] - self.hunter.y)
+    self.cache.next_step(self.hunter, main.player.x, main.player.y + main.PATH_TOLERANCE)
+    self.assertTrue(self.cache.paths[self.hunter][2] is steps)
+    self.cache.next_step(self.hunter, main.player.x, main.player.y + main.PATH_TOLERANCE + 1)
+    self.assertFalse(self.cache.paths[self.hunter][2] is steps)
+
+
+class Recorder:
+  #an AI that just notes down when it acts
+  def __init__(self, log):
+    self.log = log
+
+  def take_turn(self):
+    self.log.append(self.owner.name)
+
+class SchedulerTest(unittest.TestCase):
+  def setUp(self):
+    open_level()
+    self.log = []
+    main.scheduler.reset()
+
+  def test_actors_act_in_objects_order(self):
+    for (i, name) in enumerate('abcd'):
+      add_enemy(25, 5 + 2 * i, name, Recorder(self.log))
+    #file them in the index the other way round
+    main.object_index = main.SpatialIndex(main.map, [main.player] + main.objects[:0:-1])
+    main.scheduler.run_turn(main.player.x, main.player.y)
+    self.assertEqual(self.log, ['a', 'b', 'c', 'd'])
+
+  def test_speed_sets_how_often_actors_act(self):
+    add_enemy(26, 12, 'fast', Recorder(self.log), speed=2 * main.NORMAL_SPEED)
+    add_enemy(27, 12, 'slow', Recorder(self.log), speed=main.NORMAL_SPEED // 2)
+    for turn in range(4):
+      main.scheduler.run_turn(main.player.x, main.player.y)
+    self.assertEqual(self.log.count('fast'), 8)
+    self.assertEqual(self.log.count('slow'), 2)
+
+  def test_far_actors_sleep(self):
+    far = add_enemy(2, 2, 'far', Recorder(self.log))
+    main.scheduler.wake(far)
+    main.scheduler.run_turn(main.player.x, main.player.y)
+    self.assertEqual(self.log, [])
+    self.assertFalse(far in main.scheduler.awake)
+
+  def test_hunters_give_up_after_losing_the_player(self):
+    #a hunter far away and walled off from the player, so it can neither see nor reach them
+    open_level(width=70, player_at=(60, 12))
+    main.map.set_terrain(10, slice(None), main.TERRAIN_WALL)
+    main.initialise_FOV()
+    hunter = add_enemy(3, 12, 'hunter', main.HunterEnemy())
+    hunter.ai.hunting = True
+    for turn in range(main.HUNT_TURNS):
+      hunter.ai.take_turn()
+    self.assertTrue(hunter.ai.hunting)
+    self.assertFalse(main.scheduler.should_sleep(hunter, main.player.x, main.player.y))
+    hunter.ai.take_turn()
+    self.assertFalse(hunter.ai.hunting)
+    self.assertTrue(main.scheduler.should_sleep(hunter, main.player.x, main.player.y))
+
+
+class NoiseMapTest(unittest.TestCase):
+  def setUp(self):
+    open_level()
+    self.noise = main.NoiseMap()
+
+  def test_noise_fades_a_step_at_a_time(self):
+    self.noise.make(10, 10, 5)
+    self.noise.propagate(main.map)
+    self.assertEqual([self.noise.heard(x, 10) for x in range(10, 17)], [5, 4, 3, 2, 1, 0, 0])
+    self.assertEqual(self.noise.heard(12, 12), 3)
+
+  def test_noise_goes_around_walls(self):
+    #a wall between the noise and (14, 10) with a gap at the top
+    main.map.set_terrain(12, slice(3, None), main.TERRAIN_WALL)
+    self.noise.make(10, 10, 10)
+    self.noise.propagate(main.map)
+    self.assertEqual(self.noise.heard(12, 10), 0)
+    self.assertEqual(self.noise.heard(12, 2), 2)
+    self.assertEqual(self.noise.heard(14, 10), 0)
+    self.assertEqual(self.noise.heard(13, 3), 1)
+
+  def test_only_the_latest_noises_are_heard(self):
+    self.noise.make(10, 10, 5)
+    self.noise.propagate(main.map)
+    self.noise.propagate(main.map)
+    self.assertEqual(self.noise.heard(10, 10), 0)
+
+  def test_step_towards_the_noise(self):
+    self.noise.make(10, 10, 8)
+    self.noise.propagate(main.map)
+    (dx, dy) = self.noise.step_towards(14, 13)
+    self.assertEqual(max(abs(14 + dx - 10), abs(13 + dy - 10)), 3)
+
+  def test_listeners_in_objects_order(self):
+    for (i, name) in enumerate('abc'):
+      add_enemy(12 - i, 10, name, Recorder([]))
+    add_enemy(30, 3, 'deaf', Recorder([]))
+    main.object_index = main.SpatialIndex(main.map, [main.player] + main.objects[:0:-1])
+    main.noise_map.clear()
+    main.noise_map.make(10, 10, 6)
+    main.noise_map.propagate(main.map)
+    self.assertEqual([obj.name for obj in main.noise_map.listeners()], ['a', 'b', 'c'])
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,100 @@
+import os
+os.environ.setdefault('ARCHIVE_HEADLESS', '1')
+import multiprocessing
+import pickle
+import unittest
+
+import main
+
+'''
+Keeping and making levels: the level cache's spilling and saving, and generating levels ahead of time.
+
+  python -m unittest discover tests
+'''
+
+SEED = 424242  #(the level files made here are named by it, and removed afterwards)
+
+def setUpModule():
+  main.initialise_console()
+
+def tearDownModule():
+  main.stop_pregeneration()
+  main.remove_level_files(SEED)
+
+
+class LevelCacheTest(unittest.TestCase):
+  def setUp(self):
+    self.cache = main.LevelCache(SEED, max_bytes=2000)
+    #random bytes do not compress, so each of these takes about 1000 bytes in the cache
+    self.levels = dict((depth, {'depth': depth, 'tiles': os.urandom(1000)}) for depth in range(1, 6))
+
+  def tearDown(self):
+    self.cache.clear()
+
+  def test_spills_the_least_recently_visited(self):
+    for depth in range(1, 6):
+      self.cache.put(depth, self.levels[depth])
+    self.assertEqual(self.cache.spilled, set([1, 2, 3, 4]))
+    self.assertEqual(list(self.cache.snapshots), [5])
+    for depth in range(1, 5):
+      self.assertTrue(os.path.exists(self.cache.path(depth)))
+
+  def test_take_returns_levels_from_memory_or_disk(self):
+    for depth in range(1, 6):
+      self.cache.put(depth, self.levels[depth])
+    for depth in (2, 5):
+      self.assertEqual(self.cache.take(depth), self.levels[depth])
+      self.assertFalse(depth in self.cache)
+    self.assertFalse(os.path.exists(self.cache.path(2)))
+
+  def test_a_saved_cache_does_not_need_its_spill_files(self):
+    for depth in range(1, 6):
+      self.cache.put(depth, self.levels[depth])
+    saved = pickle.dumps(self.cache, 2)
+    self.cache.clear()  #(as starting a new game does)
+    loaded = pickle.loads(saved)
+    for depth in range(1, 6):
+      self.assertEqual(loaded.take(depth), self.levels[depth])
+
+  def test_saving_leaves_the_cache_as_it_was(self):
+    for depth in range(1, 6):
+      self.cache.put(depth, self.levels[depth])
+    pickle.dumps(self.cache, 2)
+    self.assertEqual(self.cache.spilled, set([1, 2, 3, 4]))
+    self.assertEqual(self.cache.take(3), self.levels[3])
+
+  def test_discard_removes_the_chunk_store(self):
+    path = main.LEVEL_STORE_PATH % (SEED, 3)
+    open(path, 'wb').close()
+    self.cache.put(3, self.levels[3])
+    self.cache.discard(3)
+    self.assertFalse(3 in self.cache)
+    self.assertFalse(os.path.exists(path))
+
+
+def level_state():
+  #what the current level looks like, including the order everything is filed in the object index
+  return (main.map.terrain.tolist(), [(obj.name, obj.x, obj.y) for obj in main.objects],
+          [(cell, [obj.name for obj in objs]) for (cell, objs) in main.object_index.cells.items()])
+
+class PregenerationTest(unittest.TestCase):
+  def setUp(self):
+    main.PREGENERATE_LEVELS = 0
+
+  def test_pregenerated_levels_match_built_ones(self):
+    pool = multiprocessing.Pool(1)
+    try:
+      for depth in range(2, 6):
+        main.new_game(SEED)
+        main.change_level(depth)
+        built = level_state()
+        main.new_game(SEED)
+        main.pregenerated[depth] = pool.apply_async(main.pregenerate_level, (SEED, depth))
+        main.change_level(depth)
+        self.assertEqual(level_state(), built, 'depth %d' % depth)
+    finally:
+      pool.close()
+      pool.join()
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,79 @@
+import os
+os.environ.setdefault('ARCHIVE_HEADLESS', '1')
+import unittest
+
+import main
+
+'''
+The map's occupancy bookkeeping: is_blocked and pathing only look at the impassable layer, so it has to follow
+every change to the terrain, to a tile's blocked flag and to the blocking objects standing on the map.
+
+  python -m unittest discover tests
+'''
+
+
+class OccupancyTest(unittest.TestCase):
+  def setUp(self):
+    self.map = main.TileMap(10, 8, main.TERRAIN_FLOOR)
+    self.index = main.SpatialIndex(self.map)
+
+  def rat(self, x, y, blocks=True):
+    rat = main.Object(x, y, 'r', 'rat', main.libtcod.light_grey, blocks=blocks)
+    self.index.add(rat)
+    return rat
+
+  def test_blocking_objects_make_their_tile_impassable(self):
+    rat = self.rat(2, 3)
+    self.assertTrue(self.map.impassable[2, 3])
+    (rat.x, rat.y) = (4, 3)
+    self.index.move(rat)
+    self.assertFalse(self.map.impassable[2, 3])
+    self.assertTrue(self.map.impassable[4, 3])
+    self.index.remove(rat)
+    self.assertFalse(self.map.impassable.any())
+
+  def test_tiles_stay_impassable_until_the_last_blocker_leaves(self):
+    (first, second) = (self.rat(5, 5), self.rat(5, 5))
+    self.index.remove(first)
+    self.assertTrue(self.map.impassable[5, 5])
+    self.index.remove(second)
+    self.assertFalse(self.map.impassable[5, 5])
+
+  def test_non_blocking_objects_do_not_occupy(self):
+    rat = self.rat(1, 1, blocks=False)
+    self.assertFalse(self.map.impassable[1, 1])
+    self.index.set_blocks(rat, True)
+    self.assertTrue(self.map.impassable[1, 1])
+    self.index.set_blocks(rat, False)
+    self.assertFalse(self.map.impassable[1, 1])
+
+  def test_terrain_changes_keep_occupants(self):
+    self.rat(3, 3)
+    self.map.set_terrain(slice(2, 5), 3, main.TERRAIN_WALL)
+    self.map.set_terrain(slice(2, 5), 3, main.TERRAIN_FLOOR)
+    self.assertEqual(list(self.map.impassable[2:5, 3]), [False, True, False])
+
+  def test_tile_blocked_setter_updates_impassable(self):
+    self.map[6][2].blocked = True
+    self.assertTrue(self.map.impassable[6, 2])
+    self.rat(6, 2)
+    self.map[6][2].blocked = False
+    self.assertTrue(self.map.impassable[6, 2])  #(the rat is still there)
+    self.index.remove(self.index.at(6, 2)[0])
+    self.assertFalse(self.map.impassable[6, 2])
+
+  def test_occupy_takes_slices(self):
+    self.map.occupy(slice(1, 4), slice(1, 3), 1)
+    self.assertTrue(self.map.impassable[1:4, 1:3].all())
+    self.map.occupy(slice(1, 4), slice(1, 3), -1)
+    self.assertFalse(self.map.impassable.any())
+
+  def test_clear_occupancy_keeps_walls(self):
+    self.map.set_terrain(0, slice(None), main.TERRAIN_WALL)
+    self.rat(4, 4)
+    self.map.clear_occupancy()
+    self.assertTrue(self.map.impassable[0, :].all())
+    self.assertFalse(self.map.impassable[4, 4])
+
+if __name__ == '__main__':
+  unittest.main()